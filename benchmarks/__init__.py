@@ -0,0 +1,4 @@
+"""Benchmarks driving ObjectMapper directly, without mounting, on synthetic trees.
+
+Run with: python3 -m benchmarks --help
+"""
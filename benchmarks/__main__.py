@@ -0,0 +1,56 @@
+import sys
+import json
+import os.path
+import argparse
+import tempfile
+
+from .trees import make_tree
+from .stacks import STACKS
+from .runner import run, compare, format_results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks',
+                                     description='Benchmark block stacks through ObjectMapper, without mounting.')
+    parser.add_argument('--files', type=int, default=2000, help="Number of small files")
+    parser.add_argument('--depth', type=int, default=3, help="Directory nesting")
+    parser.add_argument('--fanout', type=int, default=4, help="Subdirectories per directory")
+    parser.add_argument('--small-size', type=int, default=4096, help="Maximum size of small files")
+    parser.add_argument('--big-files', type=int, default=2, help="Number of big files")
+    parser.add_argument('--big-size', type=int, default=2 ** 26, help="Size of big files")
+    parser.add_argument('--stacks', default=','.join(STACKS), help="Comma separated stacks to run, from: {}".format(', '.join(STACKS)))
+    parser.add_argument('--no-flatten', action='store_true', help="Don't flatten passthrough layers")
+    parser.add_argument('--workdir', help="Directory for trees and caches, temporary if not given")
+    parser.add_argument('--save', metavar='FILE', help="Save results as a baseline")
+    parser.add_argument('--compare', metavar='FILE', help="Compare with a saved baseline, exit with 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative slowdown when comparing")
+    args = parser.parse_args()
+
+    stacks = args.stacks.split(',')
+    for name in stacks:
+        if name not in STACKS:
+            parser.error("unknown stack: {}".format(name))
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        source = os.path.join(workdir, 'source')
+        overlay = os.path.join(workdir, 'overlay')
+        make_tree(source, args.files, args.depth, args.fanout, args.small_size, args.big_files, args.big_size)
+        make_tree(overlay, args.files // 10, args.depth, args.fanout, args.small_size, 0, 0, seed=1)
+        results = run(stacks, source, overlay, workdir, not args.no_flatten)
+
+    print(format_results(results))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Measuring workloads against ObjectMapper and comparing results."""
+
+import os
+import time
+import resource
+import multiprocessing
+from os.path import stat
+from concurrent.futures import ProcessPoolExecutor
+
+from fuseblocks import ObjectMapper
+from fuseblocks.passthrough import flatten_stack
+
+from .stacks import STACKS
+
+
+READ_SIZE = 2 ** 17
+
+
+class Recorder:
+    """Collects latencies of single calls, by phase."""
+    def __init__(self):
+        self.latencies = {}
+
+    def call(self, phase, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.latencies.setdefault(phase, []).append(time.perf_counter() - start)
+
+
+def entry_name(entry):
+    return entry if isinstance(entry, str) else entry[0]
+
+
+def walk(mapper, recorder, phase, path='/'):
+    """Lists and stats the whole tree, like ls -lR. Returns paths of files."""
+    found = []
+    for entry in recorder.call(phase, mapper.readdir, path, 0):
+        entry_path = os.path.join(path, entry_name(entry))
+        attrs = recorder.call(phase, mapper.getattr, entry_path)
+        if stat.S_ISDIR(attrs['st_mode']):
+            found.extend(walk(mapper, recorder, phase, entry_path))
+        else:
+            found.append(entry_path)
+    return found
+
+
+def read_all(mapper, recorder, phase, paths):
+    total = 0
+    for path in paths:
+        fh = recorder.call(phase, mapper.open, path, os.O_RDONLY)
+        offset = 0
+        while True:
+            data = recorder.call(phase, mapper.read, path, READ_SIZE, offset, fh)
+            offset += len(data)
+            if len(data) < READ_SIZE:
+                break
+        recorder.call(phase, mapper.release, path, fh)
+        total += offset
+    return total
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(recorder, elapsed):
+    results = {}
+    for phase, latencies in recorder.latencies.items():
+        latencies.sort()
+        results[phase] = {'ops': len(latencies),
+                          'ops_per_s': len(latencies) / elapsed[phase] if elapsed[phase] else 0.0,
+                          'p50_us': percentile(latencies, 0.5) * 10**6,
+                          'p99_us': percentile(latencies, 0.99) * 10**6}
+    return results
+
+
+def run_stack(name, source, overlay, scratch, flatten=True):
+    """Runs all phases on one stack. Meant to run in a fresh process, so that peak RSS belongs to the stack."""
+    block = STACKS[name](source, overlay, os.path.join(scratch, name))
+    if flatten:
+        flatten_stack(block)
+    mapper = ObjectMapper('/', block)
+    recorder = Recorder()
+    elapsed = {}
+    for phase in ('walk', 'read', 'rewalk'):
+        start = time.perf_counter()
+        if phase == 'read':
+            read_all(mapper, recorder, phase, files)
+        else:
+            files = walk(mapper, recorder, phase)
+        elapsed[phase] = time.perf_counter() - start
+    results = summarize(recorder, elapsed)
+    results['peak_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def run(stacks, source, overlay, scratch, flatten=True):
+    results = {}
+    context = multiprocessing.get_context('fork')
+    for name in stacks:
+        os.makedirs(os.path.join(scratch, name), exist_ok=True)
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            results[name] = executor.submit(run_stack, name, source, overlay, scratch, flatten).result()
+    return results
+
+
+def compare(baseline, results, tolerance):
+    """Returns a list of regressions, as human readable strings."""
+    regressions = []
+    for name, phases in results.items():
+        for phase, current in phases.items():
+            old = baseline.get(name, {}).get(phase)
+            if old is None:
+                continue
+            if phase == 'peak_rss_kib':
+                if current > old * (1 + tolerance):
+                    regressions.append('{} peak RSS: {} KiB -> {} KiB'.format(name, old, current))
+                continue
+            if current['ops_per_s'] < old['ops_per_s'] * (1 - tolerance):
+                regressions.append('{} {}: {:.0f} -> {:.0f} ops/s'.format(name, phase, old['ops_per_s'], current['ops_per_s']))
+            if current['p99_us'] > old['p99_us'] * (1 + tolerance):
+                regressions.append('{} {}: p99 {:.0f} -> {:.0f} us'.format(name, phase, old['p99_us'], current['p99_us']))
+    return regressions
+
+
+def format_results(results):
+    lines = ['{:<10} {:<7} {:>8} {:>12} {:>10} {:>10}'.format('stack', 'phase', 'ops', 'ops/s', 'p50 us', 'p99 us')]
+    for name, phases in results.items():
+        for phase, values in phases.items():
+            if phase == 'peak_rss_kib':
+                continue
+            lines.append('{:<10} {:<7} {:>8} {:>12.0f} {:>10.1f} {:>10.1f}'.format(
+                name, phase, values['ops'], values['ops_per_s'], values['p50_us'], values['p99_us']))
+        lines.append('{:<10} peak RSS {} KiB'.format(name, phases['peak_rss_kib']))
+    return '\n'.join(lines)
@@ -0,0 +1,120 @@
+"""Standard block stacks to benchmark. Each factory takes (source directory, overlay directory, scratch directory)."""
+
+import os
+
+from fuseblocks import DirectoryBlock, OverlayBlock
+from fuseblocks.filter import FilterBlock
+from fuseblocks.transform import ProcessFileByEndingBlock
+from fuseblocks.cache import DataCacheBlock, AttrCacheBlock
+from fuseblocks.stats import StatsBlock
+from fuseblocks.eager import EagerBlock
+from fuseblocks.base import SIZE_EXACT_ON_OPEN
+from fuseblocks import stream, fs_cache, aio
+
+
+class TextFilter(FilterBlock):
+    def is_entry_accessible(self, path, st_type, st):
+        if st_type is not None:
+            return os.path.stat.S_ISDIR(st_type) or not path.endswith('.dat')
+        return self.is_accessible(path)
+
+    def is_accessible(self, path):
+        if os.path.stat.S_ISDIR(self.backend.getattr(path).st_mode):
+            return True
+        return not path.endswith('.dat')
+
+
+class CatFile(stream.ReadOnlyProcess):
+    def get_cmd(self, path):
+        return ['cat', path]
+
+
+class CatProcessor(stream.RawProcessBlockFS):
+    OpenFile = CatFile
+    def __init__(self, parent):
+        stream.RawProcessBlockFS.__init__(self, parent)
+        self.datasource = parent
+
+
+class SpooledCatFile(CatFile):
+    spool = True
+    spool_memory = 2 ** 12
+    def read_process(self, size):
+        if size > 2 ** 16:
+            raise AssertionError("spool filled with {} bytes at once".format(size))
+        return CatFile.read_process(self, size)
+
+
+class LimitedSpooledCat(CatProcessor):
+    OpenFile = SpooledCatFile
+    MAX_PROCESSES = 4
+
+
+class AsyncCatFile(aio.AsyncProcessFile):
+    def get_cmd(self, path):
+        return ['cat', path]
+
+
+class AsyncCat(aio.AsyncProcessBlock):
+    OpenFile = AsyncCatFile
+    MAX_PROCESSES = 4
+
+
+class EagerConversion(EagerBlock):
+    MAX_DEPTH = 1
+    def is_eager(self, path):
+        return path.endswith('.out') or os.path.basename(path).startswith('d')
+
+
+def plain(source, overlay, scratch):
+    return DirectoryBlock(source)
+
+
+def filtered(source, overlay, scratch):
+    return TextFilter(DirectoryBlock(source))
+
+
+def overlaid(source, overlay, scratch):
+    return OverlayBlock(DirectoryBlock(source), DirectoryBlock(overlay))
+
+
+def converted(source, overlay, scratch):
+    base = DirectoryBlock(source)
+    return ProcessFileByEndingBlock(base, [('.dat', '.out', False, stream.ProcessBlockFS(CatProcessor(base)))])
+
+
+def data_cache(source, overlay, scratch):
+    class DataCache(fs_cache.DataCache):
+        CACHE_PATH = os.path.join(scratch, 'cache')
+    return DataCache(CatProcessor(DirectoryBlock(source)))
+
+
+def spooled(source, overlay, scratch):
+    """Random reads straight from spooled process files, few processes allowed."""
+    return stream.VerifySizeBlock(LimitedSpooledCat(DirectoryBlock(source)))
+
+
+def exact_on_open(source, overlay, scratch):
+    return DataCacheBlock(stream.VerifySizeBlock(CatProcessor(DirectoryBlock(source)), SIZE_EXACT_ON_OPEN))
+
+
+def instrumented(source, overlay, scratch):
+    """Metadata caching and read-ahead on top of conversions, with statistics served in the tree."""
+    return StatsBlock(AttrCacheBlock(EagerConversion(StatsBlock(converted(source, overlay, scratch), 'convert'))), 'top')
+
+
+def async_process(source, overlay, scratch):
+    return stream.ProcessBlockFS(aio.SyncAdapter(AsyncCat(DirectoryBlock(source))))
+
+
+STACKS = {
+    'plain': plain,
+    'filter': filtered,
+    'overlay': overlaid,
+    'convert': converted,
+    'datacache': data_cache,
+    'spooled': spooled,
+    'exactopen': exact_on_open,
+    'stats': instrumented,
+    'aio': async_process,
+}
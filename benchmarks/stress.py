@@ -0,0 +1,190 @@
+"""Hammers ObjectMapper of each stack from many threads, checking results against a single threaded pass.
+
+Run with: python3 -m benchmarks.stress --help
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from os.path import stat
+
+from fuseblocks import ObjectMapper
+from fuseblocks.passthrough import flatten_stack
+from fuseblocks.stats import StatsBlock
+
+from .trees import make_tree
+from .stacks import STACKS
+from .runner import Recorder, walk
+
+
+OPERATIONS = ('getattr', 'readdir', 'read', 'pread', 'shared', 'invalidate', 'report')
+
+
+def read_whole(mapper, path, chunk_size):
+    fh = mapper.open(path, os.O_RDONLY)
+    try:
+        parts = []
+        offset = 0
+        while True:
+            data = mapper.read(path, chunk_size, offset, fh)
+            parts.append(data)
+            offset += len(data)
+            if len(data) < chunk_size:
+                break
+        return b''.join(parts)
+    finally:
+        mapper.release(path, fh)
+
+
+class Stress:
+    """Runs random operations on one mapper and collects failures.
+    Shared handles stay open for the whole run, after being read through once, like files kept open by an application.
+    """
+    SHARED_HANDLES = 32
+    def __init__(self, block, seed=0):
+        self.block = block
+        self.mapper = ObjectMapper('/', block)
+        self.rng = random.Random(seed)
+        self.files = walk(self.mapper, Recorder(), 'reference')
+        self.reports = [path for path in self.files if path == StatsBlock.STATS_PATH] # change all the time
+        self.files = [path for path in self.files if path not in self.reports]
+        self.contents = dict((path, read_whole(self.mapper, path, 2 ** 17)) for path in self.files)
+        self.shared = {}
+        for path in self.rng.sample(self.files, min(self.SHARED_HANDLES, len(self.files))):
+            fh = self.shared[path] = self.mapper.open(path, os.O_RDONLY)
+            self.check(self.mapper.read(path, 2 ** 30, 0, fh) == self.contents[path], "{} contents differ".format(path))
+        self.ops = 0
+        self.failures = []
+        self.lock = threading.Lock() # guards ops and failures
+
+    def check(self, condition, message):
+        if not condition:
+            raise AssertionError(message)
+
+    def run_one(self, rng):
+        op = rng.choice(OPERATIONS)
+        path = rng.choice(self.files)
+        expected = self.contents[path]
+        if op == 'getattr':
+            attrs = self.mapper.getattr(path)
+            self.check(stat.S_ISREG(attrs['st_mode']), "{} is not a file".format(path))
+            self.check(attrs['st_size'] == len(expected),
+                       "{} size {} != {}".format(path, attrs['st_size'], len(expected)))
+        elif op == 'readdir':
+            directory, name = os.path.split(path)
+            names = [entry if isinstance(entry, str) else entry[0] for entry in self.mapper.readdir(directory, 0)]
+            self.check(name in names, "{} missing from listing".format(path))
+        elif op == 'read':
+            data = read_whole(self.mapper, path, rng.choice((2 ** 12, 2 ** 16, 2 ** 17)))
+            self.check(data == expected, "{} contents differ".format(path))
+        elif op in ('pread', 'shared'):
+            if op == 'shared':
+                path = rng.choice(list(self.shared))
+                expected = self.contents[path]
+            offset = rng.randrange(len(expected) + 1)
+            size = rng.randrange(1, 2 ** 17)
+            if op == 'shared':
+                data = self.mapper.read(path, size, offset, self.shared[path])
+            else:
+                fh = self.mapper.open(path, os.O_RDONLY)
+                try:
+                    data = self.mapper.read(path, size, offset, fh)
+                finally:
+                    self.mapper.release(path, fh)
+            self.check(data == expected[offset:offset + size],
+                       "{} range {}+{} differs".format(path, offset, size))
+        elif op == 'invalidate': # contents don't change, results must stay the same
+            self.block.changed(rng.choice((path, os.path.dirname(path))), rng.random() < 0.1)
+        elif op == 'report' and self.reports: # size 0 like process output, any open serves a whole report
+            path = rng.choice(self.reports)
+            size = self.mapper.getattr(path)['st_size']
+            self.check(size == 0, "{} size {} != 0".format(path, size))
+            json.loads(read_whole(self.mapper, path, 2 ** 12).decode('utf-8'))
+
+    def worker(self, seed, deadline):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            try:
+                self.run_one(rng)
+            except Exception as e:
+                with self.lock:
+                    self.failures.append('{}: {}'.format(type(e).__name__, e))
+            with self.lock:
+                self.ops += 1
+
+    def run(self, threads, duration):
+        deadline = time.monotonic() + duration
+        workers = [threading.Thread(target=self.worker, args=(i, deadline), daemon=True) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for path, fh in self.shared.items():
+            self.mapper.release(path, fh)
+        self.check(len(self.mapper.fd_tracker) == 0, "file handles leaked")
+
+
+def run_stress(block, args, outcome):
+    """Fills outcome with 'stress' after a complete run, or with 'error'."""
+    try:
+        stress = Stress(block)
+        stress.run(args.threads, args.duration)
+        outcome['stress'] = stress
+    except Exception as e:
+        outcome['error'] = '{}: {}'.format(type(e).__name__, e)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks.stress',
+                                     description='Call block stacks through ObjectMapper from many threads and verify results.')
+    parser.add_argument('--files', type=int, default=500, help="Number of small files")
+    parser.add_argument('--big-files', type=int, default=1, help="Number of big files")
+    parser.add_argument('--big-size', type=int, default=2 ** 22, help="Size of big files")
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=5, help="Seconds per stack")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds after the duration until a stack is declared hung")
+    parser.add_argument('--stacks', default=','.join(STACKS), help="Comma separated stacks to run, from: {}".format(', '.join(STACKS)))
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, 'source')
+        overlay = os.path.join(workdir, 'overlay')
+        make_tree(source, args.files, big_files=args.big_files, big_size=args.big_size)
+        make_tree(overlay, args.files // 10, big_files=0, seed=1)
+        for name in args.stacks.split(','):
+            scratch = os.path.join(workdir, 'scratch', name)
+            os.makedirs(scratch)
+            block = STACKS[name](source, overlay, scratch)
+            flatten_stack(block)
+            outcome = {}
+            runner = threading.Thread(target=run_stress, args=(block, args, outcome), daemon=True)
+            runner.start()
+            runner.join(args.duration + args.timeout)
+            if runner.is_alive():
+                print('{:<10} hung'.format(name))
+                failed = True
+                continue # its threads can't be stopped, and may still use the tree
+            if 'error' in outcome:
+                print('{:<10} failed: {}'.format(name, outcome['error']))
+                failed = True
+                continue
+            stress = outcome['stress']
+            print('{:<10} {:>8} ops {:>6} failures'.format(name, stress.ops, len(stress.failures)))
+            for failure in stress.failures[:10]:
+                print('    ' + failure)
+            failed = failed or bool(stress.failures)
+            del block, stress, outcome
+            gc.collect() # close caches before their directories are removed
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""Synthetic source trees."""
+
+import os
+import random
+
+
+def make_tree(root, files=2000, depth=3, fanout=4, small_size=4096, big_files=2, big_size=2 ** 26,
+              convert_every=8, seed=0):
+    """Creates a directory tree with many small files spread over nested directories, and a few big files at the top.
+    Every convert_every-th file gets the '.dat' ending picked up by converting stacks, others '.txt'.
+    Returns the list of created file paths relative to root.
+    """
+    rng = random.Random(seed)
+    directories = ['']
+    level = ['']
+    for i in range(depth):
+        level = [os.path.join(parent, 'd{}'.format(j)) for parent in level for j in range(fanout)]
+        directories.extend(level)
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    created = []
+    for i in range(files):
+        ending = '.dat' if i % convert_every == 0 else '.txt'
+        path = os.path.join(rng.choice(directories), 'f{}{}'.format(i, ending))
+        with open(os.path.join(root, path), 'wb') as f:
+            f.write(os.urandom(rng.randint(small_size // 2, small_size)))
+        created.append(path)
+    chunk = os.urandom(2 ** 20)
+    for i in range(big_files):
+        path = 'big{}.dat'.format(i)
+        with open(os.path.join(root, path), 'wb') as f:
+            for written in range(0, big_size, len(chunk)):
+                f.write(chunk[:big_size - written])
+        created.append(path)
+    return created
@@ -9,6 +9,7 @@ from fuse import FUSE, LoggingMixIn, FuseOSError
 import fuseblocks
 from fuseblocks import start_fuse
 from fuseblocks.transform import ProcessFileByEndingBlock
+from fuseblocks.eager import EagerBlock
 import fuseblocks.stream
 
 import logging
@@ -29,8 +30,9 @@ class RAFFile(fuseblocks.stream.ReadOnlyProcess):
 class RAFFileProcessor(fuseblocks.stream.RawProcessBlockFS):
     OpenFile = RAFFile
 
-#class EagerRAFProcessor(fuseblocks.stream.EagerProcessBlock):
- #   OpenFile = RAFFile
+class EagerRAFConversion(EagerBlock):
+    def is_eager(self, path):
+        return path.lower().endswith('.jpg')
 
 class ProcessUFRAW(fuseblocks.stream.ProcessBlockFS):
     def __init__(self, backend):
@@ -46,5 +48,5 @@ if __name__ == '__main__':
     base_block = fuseblocks.DirectoryBlock(source_dir)
     ending_conversions = [('.raf', '.jpg', False, ProcessUFRAW(base_block))]
     
-    backend = ProcessFileByEndingBlock(base_block, ending_conversions)
+    backend = EagerRAFConversion(ProcessFileByEndingBlock(base_block, ending_conversions))
     fuseblocks.start_fuse(backend, argv[2], direct_io=True, foreground=True, mapper_class=ObjectMapper)
@@ -0,0 +1,317 @@
+"""Optional asyncio variant of the block protocol.
+
+Async blocks implement the same operations as Block, as coroutines. They run on an event loop in its own thread, so waiting for slow data (e.g. process output) doesn't hold a FUSE thread per open file.
+SyncAdapter exposes an async block as a regular Block, usable with ObjectMapper and under other blocks. AsyncAdapter does the opposite, running calls of a regular Block in a thread pool.
+
+    SyncAdapter(ConvertBlock(DirectoryBlock(source))) # ConvertBlock subclasses AsyncProcessBlock
+
+Without spooling, process output can only be read sequentially; stack DataCacheBlock on top of the SyncAdapter for random access.
+"""
+
+import os
+import errno
+import asyncio
+import functools
+import threading
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from fuse import FuseOSError
+
+from .base import Block, OpenFile, VirtStat, open_direction
+
+
+class EventLoopThread:
+    """Runs an asyncio event loop in a daemon thread.
+    run() must not be called from the loop thread itself.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """Runs coro on the loop, waits for its result in the calling thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+def shared_loop():
+    """Returns the EventLoopThread used by adapters unless given another one, starting it on first use."""
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoopThread()
+        return _shared_loop
+
+
+class AsyncOpenFile(metaclass=ABCMeta):
+    """Async counterpart of OpenFile."""
+    @abstractmethod
+    async def read(self, size, offset): pass
+    async def release(self): pass
+
+
+class AsyncBlock(metaclass=ABCMeta):
+    """Async counterpart of Block. Coroutines run on the event loop, so they must not block; use loop.run_in_executor for blocking work."""
+    @abstractmethod
+    async def access(self, path, mode): pass
+
+    @abstractmethod
+    async def getattr(self, path): pass
+
+    @abstractmethod
+    async def readdir(self, path): pass
+
+    async def readdir_attrs(self, path):
+        """See Block.readdir_attrs."""
+        return [(name, None, None) for name in await self.readdir(path)]
+
+    async def estimate_size(self, path):
+        return None
+
+    def add_listener(self, block):
+        """Async blocks don't track changes themselves, they pass announcements from blocks below unchanged."""
+        pass
+
+
+class AsyncAdapter(AsyncBlock):
+    """Exposes a regular Block as an AsyncBlock. Calls run in a pool of WORKERS threads, which bounds how many of them can block at once."""
+    WORKERS = 32
+    def __init__(self, block):
+        self.block = block
+        self.executor = ThreadPoolExecutor(self.WORKERS)
+        if hasattr(block, '_get_base_path'):
+            self._get_base_path = block._get_base_path
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def access(self, path, mode):
+        return await self._call(self.block.access, path, mode)
+
+    async def getattr(self, path):
+        return await self._call(self.block.getattr, path)
+
+    async def readdir(self, path):
+        return await self._call(lambda: list(self.block.readdir(path)))
+
+    async def readdir_attrs(self, path):
+        return await self._call(self.block.readdir_attrs, path)
+
+    async def estimate_size(self, path):
+        return await self._call(self.block.estimate_size, path)
+
+    async def open(self, path, flags):
+        return AsyncFileAdapter(await self._call(self.block.open, path, flags), self)
+
+    async def readlink(self, path):
+        return await self._call(self.block.readlink, path)
+
+    async def statvfs(self, path):
+        return await self._call(self.block.statvfs, path)
+
+    def add_listener(self, block):
+        self.block.add_listener(block)
+
+
+class AsyncFileAdapter(AsyncOpenFile):
+    def __init__(self, open_file, adapter):
+        self.f = open_file
+        self.adapter = adapter
+
+    async def read(self, size, offset):
+        return await self.adapter._call(self.f.read, size, offset)
+
+    async def release(self):
+        return await self.adapter._call(self.f.release)
+
+
+class SyncAdapter(Block):
+    """Exposes an AsyncBlock as a regular Block. Each call waits for the coroutine running on loop (shared_loop() by default).
+    Changes announced by blocks below the async ones are passed on to blocks above.
+    """
+    def __init__(self, async_block, loop=None):
+        Block.__init__(self)
+        self.async_block = async_block
+        self.loop = shared_loop() if loop is None else loop
+        async_block.add_listener(self)
+
+    def _run(self, func_name, path, *args):
+        return self.loop.run(getattr(self.async_block, func_name)(path, *args))
+
+    def access(self, path, mode):
+        return self._run('access', path, mode)
+
+    def getattr(self, path):
+        return self._run('getattr', path)
+
+    def readdir(self, path):
+        return self._run('readdir', path)
+
+    def readdir_attrs(self, path):
+        return self._run('readdir_attrs', path)
+
+    def estimate_size(self, path):
+        return self._run('estimate_size', path)
+
+    def open(self, path, flags):
+        return SyncFile(self._run('open', path, flags), self.loop)
+
+    def readlink(self, path):
+        return self._run('readlink', path)
+
+    def statvfs(self, path):
+        return self._run('statvfs', path)
+
+
+class SyncFile(OpenFile):
+    def __init__(self, async_file, loop):
+        self.f = async_file
+        self.loop = loop
+
+    def read(self, size, offset):
+        return self.loop.run(self.f.read(size, offset))
+
+    def release(self):
+        return self.loop.run(self.f.release())
+
+
+def pass_to_parent(func_name):
+    async def method(self, *args, **kwargs):
+        return await self._apply_method(func_name, *args, **kwargs)
+    return method
+
+
+class AsyncPassthrough(AsyncBlock):
+    """Passes requests through to parent block. A regular Block given as parent is wrapped in AsyncAdapter."""
+    def __init__(self, parent):
+        if not isinstance(parent, AsyncBlock):
+            parent = AsyncAdapter(parent)
+        self.parent = parent
+        if hasattr(parent, '_get_base_path'):
+            self._get_base_path = parent._get_base_path
+
+    access = pass_to_parent('access')
+    getattr = pass_to_parent('getattr')
+    open = pass_to_parent('open')
+    readlink = pass_to_parent('readlink')
+    statvfs = pass_to_parent('statvfs')
+    readdir = pass_to_parent('readdir')
+    readdir_attrs = pass_to_parent('readdir_attrs')
+    estimate_size = pass_to_parent('estimate_size')
+
+    async def _apply_method(self, func_name, path, *args, **kwargs):
+        """Override this to alter behaviour."""
+        return await getattr(self.parent, func_name)(path, *args, **kwargs)
+
+    def add_listener(self, block):
+        self.parent.add_listener(block)
+
+
+class AsyncProcessFile(AsyncOpenFile):
+    """Passes a real file through a process started with asyncio and exposes its output. Read-only, reads must be sequential.
+    Serves the same purpose as stream.ReadOnlyProcess, without holding a thread while waiting for output.
+    """
+    parent_stderr = True # print child process stderr output to the FUSE process stderr
+    exit_timeout = 60 # seconds to wait for the killed process in release()
+    semaphore = None # released once output ends, at latest on release()
+    def __init__(self, path, flags):
+        if open_direction(flags) != os.O_RDONLY or flags & os.O_APPEND:
+            raise FuseOSError(errno.EACCES)
+        self.path = path
+        self.process = None
+        self.read_offset = 0
+        self.lock = asyncio.Lock() # guards read_offset and the pipe
+
+    async def start(self):
+        stderr = None if self.parent_stderr else asyncio.subprocess.DEVNULL
+        self.process = await asyncio.create_subprocess_exec(*self.get_cmd(self.path),
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=stderr)
+
+    async def read(self, size, offset):
+        async with self.lock:
+            if self.read_offset != offset:
+                raise FuseOSError(errno.EIO)
+            try:
+                data = await self.process.stdout.readexactly(size)
+            except asyncio.IncompleteReadError as e: # end of output
+                data = e.partial
+                self.release_semaphore()
+                if self.check_failed(await self.process.wait()):
+                    raise FuseOSError(errno.EIO)
+            self.read_offset += len(data)
+            return data
+
+    async def release(self):
+        try:
+            if self.process is not None and self.process.returncode is None:
+                try:
+                    self.process.kill()
+                except ProcessLookupError:
+                    pass
+                await asyncio.wait_for(self.process.wait(), self.exit_timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.release_semaphore()
+
+    def release_semaphore(self):
+        semaphore, self.semaphore = self.semaphore, None # runs on the loop thread only, no lock needed
+        if semaphore is not None:
+            semaphore.release()
+
+    def check_failed(self, returncode):
+        """Checks whether the exit code means the output is invalid. Override to customize acceptable error codes."""
+        return returncode != 0
+
+    @abstractmethod
+    def get_cmd(self, path):
+        """Returns a list of strings, each element being an argument to the executable"""
+        pass
+
+
+class AsyncProcessBlock(AsyncPassthrough):
+    """Async counterpart of stream.RawProcessBlockFS: passes files on the filesystem through a process.
+    Requires an unbroken chain to DirectoryBlock. At most MAX_PROCESSES processes of this block run at once (None for no limit); stream.global_limiter doesn't apply.
+    Sizes are reported as 0, or estimated as SIZE_RATIO times the source size. Stack VerifySizeBlock above the adapter for exact sizes.
+    """
+    OpenFile = AsyncProcessFile
+    MAX_PROCESSES = None
+    SIZE_RATIO = None
+    def __init__(self, parent):
+        AsyncPassthrough.__init__(self, parent)
+        self.semaphore = None # created on the loop by the first open, older Pythons bind it to the current loop
+
+    async def getattr(self, path):
+        ret = VirtStat.from_stat(await self.parent.getattr(path))
+        ret.st_size = 0
+        return ret
+
+    async def estimate_size(self, path):
+        if self.SIZE_RATIO is None:
+            return None
+        return int((await self.parent.getattr(path)).st_size * self.SIZE_RATIO) + 1
+
+    async def open(self, path, flags):
+        f = self.OpenFile(self._get_base_path(path), flags)
+        if self.MAX_PROCESSES is not None:
+            if self.semaphore is None: # no await since the check, so only one gets created
+                self.semaphore = asyncio.Semaphore(self.MAX_PROCESSES)
+            await self.semaphore.acquire()
+            f.semaphore = self.semaphore
+        try:
+            await f.start()
+        except:
+            await f.release()
+            raise
+        return f
@@ -1,5 +1,7 @@
 from abc import ABCMeta, abstractmethod
-import itertools
+from operator import attrgetter
+import threading
+import contextlib
 from fuse import FuseOSError, Operations, LoggingMixIn
 
 
@@ -7,22 +9,67 @@ def open_direction(flags):
     return flags & 0x2
 
 
+# Size policies for blocks which can't tell the size of a file before generating its data
+SIZE_EXACT_ALWAYS = 'exact' # generate data whenever size is requested
+SIZE_EXACT_ON_OPEN = 'exact-on-open' # report estimates until opened, opening generates data
+SIZE_ESTIMATE = 'estimate' # report estimates until data is generated
+
+
+STAT_FIELDS = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+               'st_size', 'st_atime', 'st_mtime', 'st_ctime',
+               'st_blocks', 'st_blksize', 'st_rdev',
+               'st_atime_ns', 'st_mtime_ns', 'st_ctime_ns')
+FUSE_STAT_FIELDS = STAT_FIELDS[:-3] # fields understood by FUSE
+_get_stat_fields = attrgetter(*STAT_FIELDS)
+_get_fuse_fields = attrgetter(*FUSE_STAT_FIELDS)
+
+
+def fuse_attrs(stat):
+    """Converts os.stat_result or VirtStat into a dictionary suitable for FUSE getattr."""
+    return dict(zip(FUSE_STAT_FIELDS, _get_fuse_fields(stat)))
+
+
+def stat_fingerprint(st):
+    """Cheap identifier of file contents version, based on its metadata."""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10**9)
+    return '{}:{}:{}:{}'.format(st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
 class VirtStat:
     """Read-write os.stat_result replacement object."""
+    __slots__ = STAT_FIELDS
+    def __init__(self, st_mode=0, st_ino=0, st_dev=0, st_nlink=0, st_uid=0, st_gid=0,
+                 st_size=0, st_atime=0, st_mtime=0, st_ctime=0,
+                 st_blocks=0, st_blksize=0, st_rdev=0,
+                 st_atime_ns=None, st_mtime_ns=None, st_ctime_ns=None):
+        self.st_mode = st_mode
+        self.st_ino = st_ino
+        self.st_dev = st_dev
+        self.st_nlink = st_nlink
+        self.st_uid = st_uid
+        self.st_gid = st_gid
+        self.st_size = st_size
+        self.st_atime = st_atime
+        self.st_mtime = st_mtime
+        self.st_ctime = st_ctime
+        self.st_blocks = st_blocks
+        self.st_blksize = st_blksize
+        self.st_rdev = st_rdev
+        self.st_atime_ns = st_atime_ns
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ctime_ns = st_ctime_ns
+
     @classmethod
     def from_stat(cls, stat):
-        vstat = cls()
-        for field in dir(stat):
-            if field.startswith('st_'):
-                setattr(vstat, field, getattr(stat, field))
-        return vstat
+        """Copies os.stat_result or another VirtStat."""
+        return cls(*_get_stat_fields(stat))
 
     def __str__(self):
         return '{}({})'.format(self.__class__.__name__,
-                               ', '.join('{}={!r}'.format(name, value)
-                                         for name, value in
-                                         sorted(self.__dict__.items())
-                                         if name.startswith('st_')))
+                               ', '.join('{}={!r}'.format(name, getattr(self, name))
+                                         for name in sorted(STAT_FIELDS)))
             
 
 class BlockException(Exception):
@@ -30,6 +77,47 @@ class BlockException(Exception):
     pass
 
 
+def overrides(obj, base, *names):
+    """Checks whether the class of obj replaces any of the named methods of base."""
+    cls = type(obj)
+    return any(getattr(cls, name) is not getattr(base, name) for name in names)
+
+
+class BufferPool:
+    """Reusable bytearrays of one size, so that loops copying data don't allocate on every iteration.
+    Up to max_free buffers are kept. Safe to use from multiple threads.
+    """
+    def __init__(self, size, max_free=64):
+        self.size = size
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock() # guards free
+
+    def get(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.size)
+
+    def put(self, buf):
+        """Returns a buffer obtained from get(). Views of it must not be used afterwards."""
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buf)
+
+    @contextlib.contextmanager
+    def buffer(self):
+        """Lends a buffer for the duration of the context."""
+        buf = self.get()
+        try:
+            yield buf
+        finally:
+            self.put(buf)
+
+
+buffer_pool = BufferPool(2 ** 17) # shared by copying loops
+
+
 class FileLike:
     """Wraps OpenFile to provide a streamable file-like interface over a random-access data store.
     """
@@ -43,6 +131,17 @@ class FileLike:
         self.pos += len(d)
         return d
 
+    def readinto(self, buf):
+        n = self.f.readinto(buf, self.pos)
+        self.pos += n
+        return n
+
+    @property
+    def fd(self):
+        """Descriptor holding exactly the data read() returns, or None."""
+        get_copy_fd = getattr(self.f, 'get_copy_fd', None)
+        return None if get_copy_fd is None else get_copy_fd()
+
     # Context manager should be similar to file() behaviour:
     # - allow for acting on the file when inside context 
     # - release file resources when context is released
@@ -54,15 +153,28 @@ class FileLike:
 
 class OpenFile(metaclass=ABCMeta):
     """Basic abstraction for open files.
-    Implements FUSE functions."""
+    Implements FUSE functions.
+    FUSE may call read on the same file from several threads at once, with any offsets.
+    Files whose data is exactly that of a real file may return its descriptor from get_copy_fd(), so that data can be copied inside the kernel."""
     # TODO: fill in ABC
     @abstractmethod
     def read(self, size, offset): pass
     def release(self): pass
 
+    def readinto(self, buf, offset):
+        """Reads up to len(buf) bytes into the writable buffer buf, returns their number. Override to avoid the copy made here.
+        Overrides should fall back to this one when a subclass overrides read, see overrides().
+        """
+        data = self.read(len(buf), offset)
+        n = len(data)
+        memoryview(buf)[:n] = data
+        return n
+
 
 class Block(metaclass=ABCMeta):
-    """Basic building block that can be stacked and chained with other blocks to create a FUSE filesystem."""
+    """Basic building block that can be stacked and chained with other blocks to create a FUSE filesystem.
+    Methods are called from all FUSE threads at once, so blocks must guard state shared between calls.
+    """
     # TODO: fill in ABC
     @abstractmethod
     def access(self, path, mode): pass
@@ -73,27 +185,106 @@ class Block(metaclass=ABCMeta):
     @abstractmethod
     def readdir(self, path): pass
 
+    def readdir_attrs(self, path):
+        """Returns a list of (name, file type, stat) tuples. File type is the S_IFMT part of st_mode.
+        File type and stat are None when not known cheaply. Override when the listing provides them.
+        """
+        return [(name, None, None) for name in self.readdir(path)]
+
+    def estimate_size(self, path):
+        """Returns a cheap upper bound of the file size, or None if unknown."""
+        return None
+
+    # Change notification. Blocks register with their parents, changes are announced upwards, translated into each block's own paths.
+
+    def add_listener(self, block):
+        """block.parent_changed will be called on changes in this block."""
+        if not hasattr(self, 'listeners'):
+            self.listeners = []
+        self.listeners.append(block)
+
+    def changed(self, path, recursive=False):
+        """Announces that path (and everything below if recursive) changed. Drops own cached information and notifies listeners."""
+        self.invalidate(path, recursive)
+        for listener in getattr(self, 'listeners', ()):
+            listener.parent_changed(self, path, recursive)
+
+    def parent_changed(self, parent, path, recursive):
+        """Called when path of parent changed. Override if own paths differ from parent's."""
+        self.changed(path, recursive)
+
+    def invalidate(self, path, recursive=False):
+        """Drops cached information about path. Override in blocks which cache."""
+        pass
+
 
 class FDTracker:
-    """Helper object tracking file handles passed to FUSE."""
+    """Helper object tracking file handles passed to FUSE.
+    Released handles are reused. Safe to use from multiple threads.
+    """
     def __init__(self):
         self.handles = {}
+        self.free = [] # released handles, reused last in first out
+        self.next_handle = 1
+        self.peak = 0 # highest number of handles open at the same time
+        self.lock = threading.Lock() # guards all of the above
         
     def add(self, item):
-        for i in itertools.count(1):
-            if i not in self.handles:
-                self.handles[i] = item
-                return i
+        with self.lock:
+            if self.free:
+                i = self.free.pop()
+            else:
+                i = self.next_handle
+                self.next_handle += 1
+            self.handles[i] = item
+            self.peak = max(self.peak, len(self.handles))
+        return i
                 
     def __getitem__(self, key):
         return self.handles[key]
         
     def __delitem__(self, key):
-        del self.handles[key]
+        self.pop(key)
+
+    def pop(self, key):
+        with self.lock:
+            item = self.handles.pop(key)
+            self.free.append(key)
+        return item
+
+    def __len__(self):
+        return len(self.handles)
+
+
+class PathLocks:
+    """Locks created on demand for each path, and dropped when nobody holds or waits for them.
+    Lets expensive work on one path run once, without blocking other paths.
+    """
+    def __init__(self):
+        self.locks = {} # path to [lock, number of users]
+        self.lock = threading.Lock() # guards locks
+
+    @contextlib.contextmanager
+    def locked(self, path):
+        with self.lock:
+            item = self.locks.get(path)
+            if item is None:
+                item = self.locks[path] = [threading.Lock(), 0]
+            item[1] += 1
+        try:
+            with item[0]:
+                yield
+        finally:
+            with self.lock:
+                item[1] -= 1
+                if item[1] == 0:
+                    del self.locks[path]
 
 
 class ObjectMapper(Operations):
-    """Object that wraps Block objects in a FUSE interface."""
+    """Object that wraps Block objects in a FUSE interface.
+    Keeps no state besides file handles, so it can be used with multithreaded FUSE as long as the blocks are safe.
+    """
     def __init__(self, mount, backend):
         self.mount = mount
         self.backend = backend
@@ -104,10 +295,7 @@ class ObjectMapper(Operations):
         return self.backend.access(path, mode)
     
     def getattr(self, path, fh=None):
-        st = self.backend.getattr(path)
-        return dict((key, getattr(st, key))
-                    for key in
-                        filter(lambda x: x.startswith('st_'), dir(st)))
+        return fuse_attrs(self.backend.getattr(path))
     
     getxattr = None # to silence "operation not supported"
     
@@ -119,14 +307,21 @@ class ObjectMapper(Operations):
         return self.fd_tracker[fh].read(size, offset)
 
     def readdir(self, path, fh):
-        return self.backend.readdir(path)
+        entries = []
+        for name, st_type, st in self.backend.readdir_attrs(path):
+            if st is not None:
+                entries.append((name, fuse_attrs(st), 0))
+            elif st_type is not None:
+                entries.append((name, {'st_mode': st_type}, 0))
+            else:
+                entries.append(name)
+        return entries
     
     def readlink(self, path):
         return self.backend.readlink(path)
 
     def release(self, path, fh):
-        self.fd_tracker[fh].release()
-        del self.fd_tracker[fh]
+        self.fd_tracker.pop(fh).release()
         return 0
     
     def statvfs(self, path):
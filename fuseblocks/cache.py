@@ -1,72 +1,329 @@
-"""Deprecated. Keeping as a reference of the locking implementation."""
+"""In-memory caching of file data and metadata."""
 
 import threading
+import errno
+import time
 import os
+from collections import OrderedDict
+from fuse import FuseOSError
 
-from .base import OpenFile
+from .base import OpenFile, PathLocks, overrides
 from .passthrough import Passthrough
 
+import logging
+logger = logging.getLogger('fuseblocks.cache')
+
 
 class CacheFile(OpenFile):
-    def __init__(self, store, mode):
+    def __init__(self, store, mode, on_release=None):
         self.store = store
         self.mode = mode
-    
+        self.on_release = on_release
+
     def read(self, size, offset):
-        return self.store.data[offset:offset+size]
+        return self.store.read(size, offset)
+
+    def readinto(self, buf, offset):
+        if overrides(self, CacheFile, 'read'):
+            return OpenFile.readinto(self, buf, offset)
+        return self.store.readinto(buf, offset)
+
+    def get_size(self):
+        return self.store.wait_complete()
+
+    def release(self):
+        if self.on_release is not None:
+            self.on_release(self.store)
 
 
 class DataStore:
-    def __init__(self):
-        self.complete_lock = threading.Lock()
-        self.data = None
-    
-    def wait_more(self, length, size):
-        lock = threading.Lock()
-        self.queue.append(length, size, lock)
-        self.lock.acquire()
-        self.lock.acquire()
+    """Data of a single file, kept as a list of chunks of fixed size.
+    Filled by one producer, while readers wait only until the range they need is available.
+    """
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunks = [] # only ever appended to, so readers can index without locking
+        self.length = 0
+        self.complete = False
+        self.error = None
+        self.readers = 0
+        self.cond = threading.Condition() # guards length, complete, error; notified on change
+
+    def append(self, chunk):
+        """Adds a full chunk (or the last, shorter one)."""
+        with self.cond:
+            self.chunks.append(chunk)
+            self.length += len(chunk)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.complete = True
+            self.error = error
+            self.cond.notify_all()
+
+    def fill(self, open_file):
+        """Reads the whole file into the store. Closes open_file.
+        Full reads are stored as they are, only short reads get joined into chunks.
+        """
+        pending = []
+        missing = self.chunk_size
+        offset = 0
+        try:
+            while True:
+                new_data = open_file.read(missing, offset)
+                if len(new_data) == 0:
+                    break
+                offset += len(new_data)
+                missing -= len(new_data)
+                if missing == 0:
+                    self.append(b''.join(pending) + new_data if pending else new_data)
+                    pending = []
+                    missing = self.chunk_size
+                else:
+                    pending.append(new_data)
+            if pending:
+                self.append(b''.join(pending))
+        except Exception as e:
+            logger.exception("failed to fill cache")
+            self.finish(e)
+        else:
+            self.finish()
+        finally:
+            open_file.release()
+
+    def _raise_error(self):
+        if isinstance(self.error, FuseOSError):
+            raise self.error
+        raise FuseOSError(errno.EIO)
+
+    def wait_complete(self):
+        """Returns file size once all data is available."""
+        with self.cond:
+            while not self.complete:
+                self.cond.wait()
+            if self.error is not None:
+                self._raise_error()
+            return self.length
+
+    def _available(self, end):
+        """Waits until data up to end is available, returns the end of the available range."""
+        with self.cond:
+            while self.length < end and not self.complete:
+                self.cond.wait()
+            if self.error is not None and self.length < end:
+                self._raise_error()
+            return min(end, self.length)
+
+    def read(self, size, offset):
+        end = self._available(offset + size)
+        if offset >= end:
+            return b''
+        first = offset // self.chunk_size
+        last = (end - 1) // self.chunk_size
+        start = offset - first * self.chunk_size
+        if first == last:
+            return self.chunks[first][start:start + end - offset]
+        parts = [self.chunks[first][start:]]
+        parts.extend(self.chunks[first + 1:last])
+        parts.append(self.chunks[last][:end - last * self.chunk_size])
+        return b''.join(parts)
+
+    def readinto(self, buf, offset):
+        """Copies straight from chunks into buf, without intermediate bytes."""
+        end = self._available(offset + len(buf))
+        with memoryview(buf) as view:
+            pos = offset
+            while pos < end:
+                index, start = divmod(pos, self.chunk_size)
+                chunk = self.chunks[index]
+                n = min(len(chunk) - start, end - pos)
+                with memoryview(chunk) as chunk_view:
+                    view[pos - offset:pos - offset + n] = chunk_view[start:start + n]
+                pos += n
+        return max(end - offset, 0)
 
 
 class DataCacheBlock(Passthrough):
-    """Caches file data."""
+    """Caches file data in memory.
+    Files are produced in a background thread on first open. Reads are served as soon as the requested range is available.
+    Complete files which are not open are evicted in least recently used order when data exceeds MAX_SIZE bytes.
+    Concurrent first opens of the same path start a single producer. Backend opens don't block cache hits on other paths.
+    """
+    CHUNK_SIZE = 2 ** 16
+    MAX_SIZE = 2 ** 28
     def __init__(self, backend):
-        self.backend = backend
-        self.data_mapping = {}
-        self.mapping_lock = threading.Lock() # guards data_mapping
-    
+        Passthrough.__init__(self, backend)
+        self.data_mapping = OrderedDict() # least recently used first
+        self.mapping_lock = threading.Lock() # guards data_mapping and readers counts
+        self.path_locks = PathLocks() # serializes starting producers
+
     def get_cache(self, path):
-        self.mapping_lock.acquire()
-        try:
-            if path not in self.data_mapping:
-                open_file = Passthrough.open(self, path, os.O_RDONLY)
-                store = DataStore()
+        store = self._use_store(path)
+        if store is not None:
+            return store
+        with self.path_locks.locked(path):
+            store = self._use_store(path) # started while waiting
+            if store is not None:
+                return store
+            open_file = Passthrough.open(self, path, os.O_RDONLY)
+            store = DataStore(self.CHUNK_SIZE)
+            store.readers += 1
+            with self.mapping_lock:
                 self.data_mapping[path] = store
-                with store.complete_lock:
-                    self.mapping_lock.release()
-                    data = b''
-                    offset = 0
-                    readsize = 2 ** 16
-                    while True:
-                        new_data = open_file.read(readsize, offset)
-                        data += new_data
-                        offset = len(data)
-                        if len(new_data) < readsize:
-                            break
-                    store.data = data
-                open_file.release()
-            else:
-                store = self.data_mapping[path]
-                self.mapping_lock.release()
-                with store.complete_lock:
-                    pass
+        threading.Thread(target=self._produce, args=(store, open_file), daemon=True).start()
+        return store
+
+    def _use_store(self, path):
+        with self.mapping_lock:
+            store = self.data_mapping.get(path)
+            if store is None or store.error is not None:
+                return None
+            self.data_mapping.move_to_end(path)
+            store.readers += 1
             return store
-        except:
-            try: # no nice way to only catch errors up until some point in alternative ifs
-                self.mapping_lock.release()
-            except RuntimeError:
-                pass
-            raise
+
+    def cached_size(self, path):
+        """Returns size of the file if it's completely in the cache, otherwise None."""
+        with self.mapping_lock:
+            store = self.data_mapping.get(path)
+        if store is None or not store.complete or store.error is not None:
+            return None
+        return store.length
+
+    def _produce(self, store, open_file):
+        store.fill(open_file)
+        with self.mapping_lock:
+            self._evict()
+
+    def _release(self, store):
+        with self.mapping_lock:
+            store.readers -= 1
+            self._evict()
+
+    def _evict(self):
+        """Must be called with mapping_lock held."""
+        total = sum(store.length for store in self.data_mapping.values())
+        if total <= self.MAX_SIZE:
+            return
+        for path, store in list(self.data_mapping.items()):
+            if total <= self.MAX_SIZE:
+                break
+            if store.readers > 0 or not store.complete:
+                continue
+            del self.data_mapping[path]
+            total -= store.length
 
     def open(self, path, mode):
-        return CacheFile(self.get_cache(path), mode)
+        return CacheFile(self.get_cache(path), mode, self._release)
+
+    def invalidate(self, path, recursive=False):
+        """Forgets data of path. Files already open keep reading old data."""
+        with self.mapping_lock:
+            self.data_mapping.pop(path, None)
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                for cached in [p for p in self.data_mapping if p.startswith(prefix)]:
+                    del self.data_mapping[cached]
+
+
+_MISSING = object()
+_NOENT = object() # path known not to exist
+
+
+class AttrCacheBlock(Passthrough):
+    """Caches metadata: getattr results, directory listings, and nonexistence of paths.
+    Entries expire after their TTL in seconds (None: never expire, 0: don't cache) and least recently used ones are dropped above MAX_ENTRIES and MAX_LISTINGS.
+    Blocks or applications changing underlying files must call invalidate().
+    Misses are fetched outside the lock, so concurrent misses of one path may each call the parent.
+    """
+    ATTR_TTL = 1
+    NEGATIVE_TTL = 1
+    READDIR_TTL = 1
+    MAX_ENTRIES = 2 ** 17
+    MAX_LISTINGS = 2 ** 12
+    def __init__(self, parent):
+        Passthrough.__init__(self, parent)
+        self.attrs = OrderedDict() # path to (expiry, stat or _NOENT), least recently used first
+        self.listings = OrderedDict() # path to (expiry, entries)
+        self.generation = 0 # incremented on invalidation, prevents storing results fetched before it
+        self.lock = threading.Lock() # guards all of the above
+
+    def _lookup(self, mapping, path):
+        with self.lock:
+            item = mapping.get(path)
+            if item is None:
+                return _MISSING
+            expiry, value = item
+            if expiry is not None and expiry < time.monotonic():
+                del mapping[path]
+                return _MISSING
+            mapping.move_to_end(path)
+            return value
+
+    def _store(self, mapping, path, value, ttl, limit, generation):
+        if ttl == 0:
+            return
+        expiry = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            if generation != self.generation:
+                return
+            mapping[path] = (expiry, value)
+            mapping.move_to_end(path)
+            while len(mapping) > limit:
+                mapping.popitem(last=False)
+
+    def _fetch(self, mapping, func_name, path, ttl, limit):
+        generation = self.generation
+        try:
+            value = Passthrough._apply_method(self, func_name, path)
+        except FuseOSError as e:
+            if e.errno == errno.ENOENT:
+                self._store(self.attrs, path, _NOENT, self.NEGATIVE_TTL, self.MAX_ENTRIES, generation)
+            raise
+        if func_name == 'readdir':
+            value = list(value)
+        self._store(mapping, path, value, ttl, limit, generation)
+        return value
+
+    def getattr(self, path):
+        st = self._lookup(self.attrs, path)
+        if st is _NOENT:
+            raise FuseOSError(errno.ENOENT)
+        if st is _MISSING:
+            st = self._fetch(self.attrs, 'getattr', path, self.ATTR_TTL, self.MAX_ENTRIES)
+        return st
+
+    def readdir(self, path):
+        if self._lookup(self.attrs, path) is _NOENT:
+            raise FuseOSError(errno.ENOENT)
+        entries = self._lookup(self.listings, path)
+        if entries is _MISSING:
+            entries = self._fetch(self.listings, 'readdir', path, self.READDIR_TTL, self.MAX_LISTINGS)
+        return list(entries)
+
+    def _apply_method(self, func_name, path, *args, **kwargs):
+        if self._lookup(self.attrs, path) is _NOENT:
+            raise FuseOSError(errno.ENOENT)
+        return Passthrough._apply_method(self, func_name, path, *args, **kwargs)
+
+    def invalidate(self, path, recursive=False):
+        """Forgets cached information about path and the listing of its parent directory.
+        recursive: also forget everything below path
+        """
+        parent = os.path.dirname(path)
+        with self.lock:
+            self.generation += 1
+            for mapping in (self.attrs, self.listings):
+                mapping.pop(path, None)
+                if recursive:
+                    prefix = path.rstrip('/') + '/'
+                    for cached in [p for p in mapping if p.startswith(prefix)]:
+                        del mapping[cached]
+            self.listings.pop(parent, None)
+
+    def invalidate_all(self):
+        with self.lock:
+            self.generation += 1
+            self.attrs.clear()
+            self.listings.clear()
@@ -0,0 +1,100 @@
+"""Blocks that do work ahead of requests."""
+
+import os
+import threading
+from collections import deque
+from os.path import stat
+
+from .passthrough import Passthrough
+from .stream import background_priority, read_file_size
+
+import logging
+logger = logging.getLogger('fuseblocks.eager')
+
+
+class EagerBlock(Passthrough):
+    """Reads files in the background as soon as their directory is listed, so that caches below are filled before the files are opened.
+    Useful above ProcessFileByEndingBlock or a DataCache stack.
+
+    WORKERS threads read at most MAX_ENTRIES entries of each listed directory, descending MAX_DEPTH levels into subdirectories.
+    With CANCEL_ON_LEAVE, listing another directory drops work queued for the previous one. Work in progress is always finished.
+    Nothing is read unless is_eager is overridden to select entries worth reading, e.g. ones that are converted, and directories when MAX_DEPTH > 0.
+    The queue is guarded by a condition; a path is queued at most once at a time.
+    """
+    WORKERS = 2
+    MAX_ENTRIES = 256
+    MAX_DEPTH = 0
+    CANCEL_ON_LEAVE = True
+    def __init__(self, parent):
+        Passthrough.__init__(self, parent)
+        self.queue = deque() # (path, depth, file type or None)
+        self.queued = set() # paths in queue
+        self.current = None # last listed directory
+        self.cond = threading.Condition() # guards all of the above
+        for i in range(self.WORKERS):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def is_eager(self, path):
+        """Decides whether path is worth reading ahead. Should be cheap, it's called on every listed entry.
+        Plain files gain nothing from being read ahead, so by default nothing is.
+        """
+        return False
+
+    def readdir(self, path):
+        return [name for name, st_type, st in self.readdir_attrs(path)]
+
+    def readdir_attrs(self, path):
+        entries = list(self._apply_method('readdir_attrs', path))
+        with self.cond:
+            if self.CANCEL_ON_LEAVE and path != self.current:
+                self._cancel()
+            self.current = path
+        self._enqueue(path, entries, 0)
+        return entries
+
+    def cancel(self):
+        """Drops all queued work."""
+        with self.cond:
+            self._cancel()
+
+    def _cancel(self):
+        self.queue.clear()
+        self.queued.clear()
+
+    def _enqueue(self, path, entries, depth):
+        with self.cond:
+            for name, st_type, st in entries[:self.MAX_ENTRIES]:
+                entry_path = os.path.join(path, name)
+                if entry_path in self.queued or not self.is_eager(entry_path):
+                    continue
+                self.queue.append((entry_path, depth, st_type))
+                self.queued.add(entry_path)
+            self.cond.notify_all()
+
+    def _work(self):
+        with background_priority():
+            while True:
+                with self.cond:
+                    while not self.queue:
+                        self.cond.wait()
+                    path, depth, st_type = self.queue.popleft()
+                    self.queued.discard(path)
+                try:
+                    self.warm(path, depth, st_type)
+                except Exception:
+                    logger.exception("reading ahead {!r} failed".format(path))
+
+    def warm(self, path, depth, st_type=None):
+        """st_type: file type from the listing, checked with the parent if None"""
+        if st_type is None:
+            st_type = self.parent.getattr(path).st_mode
+        if stat.S_ISDIR(st_type):
+            if depth < self.MAX_DEPTH:
+                self._enqueue(path, list(self.parent.readdir_attrs(path)), depth + 1)
+            return
+        logger.debug("reading ahead {!r}".format(path))
+        open_file = self.parent.open(path, os.O_RDONLY)
+        try:
+            read_file_size(open_file)
+        finally:
+            open_file.release()
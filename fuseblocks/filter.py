@@ -1,5 +1,9 @@
 import os.path
 import errno
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABCMeta, abstractmethod
 from fuse import FuseOSError
 from .base import Block
@@ -8,22 +12,94 @@ from .passthrough import Passthrough
 
 def approved(func):
     def method(self, path, *args, **kwargs):
-        if not self.is_accessible(path):
+        if not self.check_accessible(path):
             raise FuseOSError(errno.ENOENT)
         return func(self, path, *args, **kwargs)
     return method
 
 
 class FilterBlock(Passthrough, metaclass=ABCMeta):
+    """Hides paths for which is_accessible returns False.
+    Up to DECISIONS results of is_accessible are remembered for DECISION_TTL seconds (None: until invalidated). Call invalidate() when files change.
+    With WORKERS > 0, entries of a listed directory are decided in parallel by that many threads.
+    is_accessible may be called concurrently, also for the same path when it's not yet decided.
+    """
+    DECISIONS = 2 ** 16
+    DECISION_TTL = 10
+    WORKERS = 0
+    def __init__(self, parent):
+        Passthrough.__init__(self, parent)
+        self.decisions = OrderedDict() # path to (expiry, accessible), least recently used first
+        self.decisions_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(self.WORKERS) if self.WORKERS > 0 else None
+
     @approved
     def readdir(self, path):
-        return [entname for entname in self.backend.readdir(path) if self.is_accessible(os.path.join(path, entname))]
+        return [name for name, st_type, st in self._accessible_entries(path)]
+
+    @approved
+    def readdir_attrs(self, path):
+        return self._accessible_entries(path)
+
+    def _accessible_entries(self, path):
+        entries = self.backend.readdir_attrs(path)
+        def decide(entry):
+            name, st_type, st = entry
+            return self.check_accessible(os.path.join(path, name), st_type, st)
+        if self.pool is None or len(entries) < 2:
+            decisions = map(decide, entries)
+        else:
+            decisions = self.pool.map(decide, entries)
+        return [entry for entry, accessible in zip(entries, list(decisions)) if accessible]
 
     def _apply_method(self, func_name, path, *args, **kwargs):
         """Override this to alter behaviour."""
-        if not self.is_accessible(path):
+        if not self.check_accessible(path):
             raise FuseOSError(errno.ENOENT)
         return getattr(self.backend, func_name)(path, *args, **kwargs)
 
+    def check_accessible(self, path, st_type=None, st=None):
+        """Remembered result of is_entry_accessible."""
+        with self.decisions_lock:
+            item = self.decisions.get(path)
+            if item is not None:
+                expiry, accessible = item
+                if expiry is None or expiry >= time.monotonic():
+                    self.decisions.move_to_end(path)
+                    return accessible
+                del self.decisions[path]
+        accessible = self.is_entry_accessible(path, st_type, st)
+        expiry = None if self.DECISION_TTL is None else time.monotonic() + self.DECISION_TTL
+        with self.decisions_lock:
+            self.decisions[path] = (expiry, accessible)
+            while len(self.decisions) > self.DECISIONS:
+                self.decisions.popitem(last=False)
+        return accessible
+
+    def invalidate(self, path, recursive=False):
+        """Forgets decisions about path and its ancestors, which may depend on it.
+        recursive: also forget decisions below path
+        """
+        with self.decisions_lock:
+            ancestor = path
+            while True:
+                self.decisions.pop(ancestor, None)
+                parent = os.path.dirname(ancestor)
+                if parent == ancestor:
+                    break
+                ancestor = parent
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                for decided in [p for p in self.decisions if p.startswith(prefix)]:
+                    del self.decisions[decided]
+
+    def invalidate_all(self):
+        with self.decisions_lock:
+            self.decisions.clear()
+
     @abstractmethod
     def is_accessible(self, path): pass
+
+    def is_entry_accessible(self, path, st_type, st):
+        """Decides about a listed entry. Override to make use of file type and stat from the listing, which may be None."""
+        return self.is_accessible(path)
@@ -3,13 +3,17 @@ Currently works best when data of an input file is transformed in an expensive w
 """
 
 import os
+import dbm
+import time
 import hashlib
 import tempfile
+import threading
 from os.path import stat
-from collections import namedtuple
+from collections import namedtuple, Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
-from .base import OpenFile, FileLike, VirtStat
-from .realfs import FSFile
+from .base import OpenFile, FileLike, VirtStat, PathLocks, BufferPool, buffer_pool, stat_fingerprint, SIZE_EXACT_ALWAYS
+from .realfs import FSFile, copy_fd
 from .passthrough import Passthrough
 
 import logging
@@ -18,80 +22,334 @@ logger = logging.getLogger('fuseblocks.fs_cache')
 
 class CachedFSFile(FSFile):
     """Allows to use the cached file for supplying information that must be generated."""
+    USE_MMAP = True # cache files are never modified in place
+    SEQUENTIAL = True
+    def __init__(self, path, flags, store=None, hash_=None):
+        FSFile.__init__(self, path, flags)
+        self.store = store
+        self.hash_ = hash_
+
     def get_size(self):
-        return VirtStat.from_stat(os.fstat(self.fd)).st_size
+        return os.fstat(self.fd).st_size
+
+    def release(self):
+        FSFile.release(self)
+        if self.store is not None:
+            self.store.unpin(self.hash_)
+
+
+class CacheEntry:
+    """Accounting information about one stored file."""
+    __slots__ = ('size', 'last_access', 'hits')
+    def __init__(self, size, last_access, hits=0):
+        self.size = size
+        self.last_access = last_access
+        self.hits = hits
+
+
+def _read_full(src, buf):
+    """Fills buf from stream src, stopping short only at the end of data. Returns the number of bytes read."""
+    filled = 0
+    with memoryview(buf) as view:
+        while filled < len(view):
+            n = src.readinto(view[filled:])
+            if n == 0:
+                break
+            filled += n
+    return filled
 
 
 class FSStore:
     """Stores file data in filesystem.
-    Stores data as files with filenames matching their md5 hash.
+    Stores data as files named after the hash of their source, prefixed by a label of the hash method (see hash_label), so that entries made by different methods can coexist.
+    Sources are hashed with HashAlg in updates of HASH_CHUNK bytes. With TREE_SEGMENT set, segments of that many bytes are hashed in parallel by HASH_WORKERS threads, and the hash of their concatenated digests is used. Changing the method doesn't invalidate existing entries: sources already in the index keep their old hashes until they change.
     
     Mappings matches path to hash.
-    TODO: delete when overflowing
-    TODO: watch for changes.
+    When MAX_SIZE (bytes) or MAX_FILES is set, least recently (EVICTION = 'lru') or least frequently ('lfu') accessed files are deleted to stay within the budget. Files which are currently open are never deleted.
+    Usage is recovered by scanning the directory on startup, access times are kept in file mtimes.
+    Source fingerprints (see stat_fingerprint) are mapped to hashes in a persistent index, so that sources don't need rehashing after restart.
+    Parents should forget() ids whose source changed.
+    Safe to use from many threads. Files are written under temporary names and renamed into place, so concurrent updates of the same contents don't corrupt each other.
     """
     OpenFile = CachedFSFile
-    HashAlg = hashlib.md5
+    HashAlg = hashlib.md5 # any hashlib constructor, e.g. hashlib.blake2b
+    HASH_CHUNK = 2 ** 20 # bytes
+    TREE_SEGMENT = None # bytes, None to hash serially
+    HASH_WORKERS = 4
+    MAX_SIZE = None # bytes, None for unlimited
+    MAX_FILES = None
+    EVICTION = 'lru'
+    ACCESS_RESOLUTION = 60 # seconds; access times are written to disk only when older than this
+    TMP_PREFIX = '.partial-'
+    INDEX_NAME = '.index'
     def __init__(self, path):
         self.path = path # path to directory containing files
         self.hashes = {} # id to hash mapping
+        self.entries = {} # hash to CacheEntry
+        self.pins = Counter() # hash to number of open files
+        self.total_size = 0
+        self.lock = threading.Lock() # guards hashes, entries, pins and total_size
         if not os.path.isdir(path):
             os.mkdir(path)
-    
+        self.scan()
+        self.index = dbm.open(os.path.join(path, self.INDEX_NAME), 'c') # fingerprint to hash mapping
+        self.index_lock = threading.Lock()
+        self.hash_label = self.get_hash_label()
+        if self.TREE_SEGMENT is None:
+            self.hash_buffers = BufferPool(self.HASH_CHUNK, 4)
+            self.hash_pool = None
+        else:
+            self.hash_buffers = BufferPool(self.TREE_SEGMENT, self.HASH_WORKERS + 1)
+            self.hash_pool = ThreadPoolExecutor(self.HASH_WORKERS)
+
+    def get_hash_label(self):
+        """Prefix of hashes identifying how they were made. Empty for serial md5, which was used before labels existed."""
+        name = self.HashAlg().name
+        if self.TREE_SEGMENT is not None:
+            name = '{}-tree{}'.format(name, self.TREE_SEGMENT)
+        return '' if name == 'md5' else name + '-'
+
+    def hash_stream(self, src):
+        """Returns the labelled hash of contents of stream src."""
+        if self.hash_pool is not None:
+            return self.hash_label + self._tree_hash(src)
+        halg = self.HashAlg()
+        with self.hash_buffers.buffer() as buf, memoryview(buf) as view:
+            while True:
+                n = _read_full(src, buf)
+                halg.update(view[:n])
+                if n < len(buf):
+                    break
+        return self.hash_label + halg.hexdigest()
+
+    def _tree_hash(self, src):
+        """Reads segments sequentially while the pool hashes them, at most HASH_WORKERS ahead of combining."""
+        root = self.HashAlg()
+        pending = deque() # (future, buffer) in order of segments
+        def combine_first():
+            future, buf = pending.popleft()
+            root.update(future.result())
+            self.hash_buffers.put(buf)
+        while True:
+            buf = self.hash_buffers.get()
+            n = _read_full(src, buf)
+            if n == 0:
+                self.hash_buffers.put(buf)
+                break
+            pending.append((self.hash_pool.submit(self._hash_segment, buf, n), buf))
+            if len(pending) > self.HASH_WORKERS:
+                combine_first()
+            if n < len(buf):
+                break
+        while pending:
+            combine_first()
+        return root.hexdigest()
+
+    def _hash_segment(self, buf, size):
+        with memoryview(buf) as view, view[:size] as segment:
+            return self.HashAlg(segment).digest()
+
+    def scan(self):
+        """Rebuild usage accounting from directory contents."""
+        with self.lock:
+            self.entries = {}
+            self.total_size = 0
+            for name in os.listdir(self.path):
+                file_path = os.path.join(self.path, name)
+                if name.startswith(self.TMP_PREFIX): # left over by an interrupted update
+                    os.unlink(file_path)
+                    continue
+                if name.startswith('.'): # index
+                    continue
+                st = os.stat(file_path)
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                self.entries[name] = CacheEntry(st.st_size, max(st.st_atime, st.st_mtime))
+                self.total_size += st.st_size
+        logger.info("cache contains {} files, {} bytes".format(len(self.entries), self.total_size))
+
+    def _open(self, hash_):
+        """Opens stored file and protects it from eviction until released. Raises FileNotFoundError."""
+        f = self._open_pinned(hash_)
+        self._touch(hash_)
+        return f
+
+    def _open_pinned(self, hash_):
+        """Pins hash_, then opens its file outside of the lock. Raises FileNotFoundError."""
+        with self.lock:
+            self.pins[hash_] += 1
+        try:
+            return self.OpenFile(os.path.join(self.path, hash_), os.O_RDONLY, self, hash_)
+        except:
+            self.unpin(hash_)
+            raise
+
+    def _touch(self, hash_):
+        """Records an access for eviction."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(hash_)
+            if entry is None:
+                return
+            stale = now - entry.last_access > self.ACCESS_RESOLUTION
+            entry.last_access = now
+            entry.hits += 1
+        if stale:
+            try:
+                os.utime(os.path.join(self.path, hash_), (now, now))
+            except OSError:
+                pass
+
+    def unpin(self, hash_):
+        with self.lock:
+            self.pins[hash_] -= 1
+            if self.pins[hash_] <= 0:
+                del self.pins[hash_]
+            self._evict()
+
+    def _over_budget(self):
+        return ((self.MAX_SIZE is not None and self.total_size > self.MAX_SIZE)
+                or (self.MAX_FILES is not None and len(self.entries) > self.MAX_FILES))
+
+    def _evict(self):
+        """Deletes unused files until the budget is met. Must be called with lock held."""
+        if not self._over_budget():
+            return
+        if self.EVICTION == 'lfu':
+            key = lambda item: (item[1].hits, item[1].last_access)
+        else:
+            key = lambda item: item[1].last_access
+        candidates = sorted(((hash_, entry) for hash_, entry in self.entries.items()
+                             if hash_ not in self.pins),
+                            key=key)
+        for hash_, entry in candidates:
+            if not self._over_budget():
+                break
+            try:
+                os.unlink(os.path.join(self.path, hash_))
+            except FileNotFoundError:
+                pass
+            del self.entries[hash_]
+            self.total_size -= entry.size
+            logger.debug("evicted {}".format(hash_))
+
     def get(self, id_):
         """Fetch file from cache.
         
         id_: arbitrary unique id of the file which is useful to parent, usually path
         """
+        with self.lock:
+            hash_ = self.hashes.get(id_)
+        if hash_ is None:
+            return None
         try:
-            hash_ = self.hashes[id_]
-        except KeyError:
+            f = self._open(hash_)
+        except FileNotFoundError: # evicted
             return None
         logger.debug("run cache hit")
-        cache_path = os.path.join(self.path, hash_)
-        return self.OpenFile(cache_path, os.O_RDONLY)
+        return f
+
+    def get_size(self, id_):
+        """Returns the size of the stored file, or None. Doesn't count as an access."""
+        with self.lock:
+            hash_ = self.hashes.get(id_)
+        if hash_ is None:
+            return None
+        try:
+            return os.stat(os.path.join(self.path, hash_)).st_size
+        except FileNotFoundError: # evicted
+            return None
 
-    def rehash(self, id_, src):
+    def forget(self, id_, recursive=False):
+        """Drops parent's hash, stored data is kept for other ids with the same contents.
+        recursive: also drop ids below id_, treated as a path
+        """
+        with self.lock:
+            self.hashes.pop(id_, None)
+            if recursive:
+                prefix = id_.rstrip('/') + '/'
+                for known in [i for i in self.hashes if i.startswith(prefix)]:
+                    del self.hashes[known]
+
+    def lookup(self, id_, fingerprint):
+        """Restore parent's hash from the persistent index. Returns True if the fingerprint was known.
+
+        id_: file identifier useful to the parent block
+        fingerprint: string identifying the version of the source
+        """
+        with self.index_lock:
+            try:
+                hash_ = self.index[fingerprint]
+            except KeyError:
+                return False
+        with self.lock:
+            self.hashes[id_] = hash_.decode('ascii')
+        return True
+
+    def rehash(self, id_, src, fingerprint=None):
         """Refresh parent's hash and return if cached version found.
 
         id_: file identifier useful to the parent block
         src: stream to hash
+        fingerprint: if given, the resulting hash is stored in the persistent index under this key
         """
         logger.info("rehashing")
-        halg = self.HashAlg()
         with src:
-            while True:
-                chunk = src.read(2**16)
-                if len(chunk) == 0:
-                    break
-                halg.update(chunk)
-        hash_ = halg.hexdigest()
-        self.hashes[id_] = hash_
-        cached_path = os.path.join(self.path, hash_)
+            hash_ = self.hash_stream(src)
+        with self.lock:
+            self.hashes[id_] = hash_
+        if fingerprint is not None:
+            with self.index_lock:
+                self.index[fingerprint] = hash_
+                if hasattr(self.index, 'sync'):
+                    self.index.sync()
         try:
-            return self.OpenFile(cached_path, os.O_RDONLY)
+            return self._open(hash_)
         except FileNotFoundError:
             return None
 
     def update(self, id_, src):
         """Regenerate cache contents. Expects the hash is already known.
+        If id_ was forgotten in the meantime, the data is returned without being kept.
+        Data of real files is copied inside the kernel.
 
         id_: file identifier useful to parent
         data_stream: stream with data to store
         """
         logger.info("updating cache")
-        hash_ = self.hashes[id_]
+        with self.lock:
+            hash_ = self.hashes.get(id_)
         with src:
-            with tempfile.NamedTemporaryFile(mode='w+b', dir=self.path, delete=False) as dest:
-                while True:
-                    chunk = src.read(2**16)
-                    if len(chunk) == 0:
-                        break
-                    dest.write(chunk)
-            dest_name = dest.name
+            with tempfile.NamedTemporaryFile(mode='w+b', dir=self.path, prefix=self.TMP_PREFIX, delete=False) as dest:
+                if src.fd is not None:
+                    size = copy_fd(src.fd, dest.fileno())
+                else:
+                    with buffer_pool.buffer() as buf, memoryview(buf) as view:
+                        while True:
+                            n = src.readinto(buf)
+                            if n == 0:
+                                break
+                            dest.write(view[:n])
+                    size = dest.tell()
+        if hash_ is None:
+            f = self.OpenFile(dest.name, os.O_RDONLY)
+            os.unlink(dest.name)
+            return f
         cached_path = os.path.join(self.path, hash_)
-        os.rename(dest.name, cached_path)
-        return self.OpenFile(cached_path, os.O_RDONLY)
+        with self.lock:
+            os.rename(dest.name, cached_path)
+            old = self.entries.pop(hash_, None)
+            if old is not None:
+                self.total_size -= old.size
+            self.entries[hash_] = CacheEntry(size, time.time())
+            self.total_size += size
+            self.pins[hash_] += 1 # released by the returned file
+            self._evict()
+        try:
+            return self.OpenFile(cached_path, os.O_RDONLY, self, hash_)
+        except:
+            self.unpin(hash_)
+            raise
 
 
 class DataCache(Passthrough):
@@ -100,36 +358,63 @@ class DataCache(Passthrough):
     Meant to be used with layers which perform expensive operations in order to arrive at file data. These layers should do no path processing.
     
     To use, inherit and set CACHE_PATH.
+    Unless SIZE_POLICY is SIZE_EXACT_ALWAYS, sizes of files not yet in cache are estimated by the parent if possible, see base.SIZE_*.
+    Concurrent opens of the same path wait for a single conversion, other paths proceed in parallel.
     """
     CACHE_PATH = None # directory where temporary data will be stored
     Store = FSStore
+    SIZE_POLICY = SIZE_EXACT_ALWAYS
     def __init__(self, parent):
         self.store = self.Store(self.CACHE_PATH)
+        self.path_locks = PathLocks()
         Passthrough.__init__(self, parent)
 
     def getattr(self, path):
         ret = Passthrough.getattr(self, path)
         if stat.S_ISDIR(ret.st_mode):
             return ret
-        f = self.open(path, os.O_RDONLY)
+        size = self.cached_size(path)
+        if size is None and self.SIZE_POLICY != SIZE_EXACT_ALWAYS:
+            size = self.parent.estimate_size(path)
+        if size is None:
+            f = self.open(path, os.O_RDONLY)
+            try:
+                size = f.get_size()
+            finally:
+                f.release()
         ret = VirtStat.from_stat(ret)
-        ret.st_size = f.get_size()
+        ret.st_size = size
         return ret
 
+    def cached_size(self, path):
+        """Returns size of the file if it's in the cache, without generating it or counting an access, otherwise None."""
+        if not self.store.lookup(path, self.get_fingerprint(path)):
+            return None
+        return self.store.get_size(path)
+
+    def invalidate(self, path, recursive=False):
+        self.store.forget(path, recursive)
+
+    def get_fingerprint(self, path):
+        return stat_fingerprint(self.parent.datasource.getattr(path))
+
     def open(self, path, flags):
         if flags & (os.O_WRONLY | os.O_RDWR):
             raise NotImplementedError("Only reading supported.")
-        cached = self.store.get(path)
-        if cached is not None:
-            return cached
         # ASSUMPTION: parent transforms file data but does not create any
         # ASSUMPTION: parent does not change paths
         # these assumptions allow us to reach for parent.parent.open directly
         # A more elegant solution would implement a "datasource" interface on cacheable transformation blocks.
-        cached = self.store.rehash(path,
-            FileLike(self.parent.datasource.open(path, os.O_RDONLY)))
-        if cached is not None:
-            return cached
+        with self.path_locks.locked(path):
+            fingerprint = self.get_fingerprint(path)
+            if self.store.lookup(path, fingerprint): # source unchanged, no need to read it
+                cached = self.store.get(path)
+            else:
+                cached = self.store.rehash(path,
+                    FileLike(self.parent.datasource.open(path, os.O_RDONLY)),
+                    fingerprint)
+            if cached is not None:
+                return cached
 
-        return self.store.update(path,
-            FileLike(Passthrough.open(self, path, os.O_RDONLY)))
+            return self.store.update(path,
+                FileLike(Passthrough.open(self, path, os.O_RDONLY)))
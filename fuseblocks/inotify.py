@@ -0,0 +1,162 @@
+"""Watching directory trees for changes using Linux inotify, without dependencies beyond ctypes."""
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+import logging
+logger = logging.getLogger('fuseblocks.inotify')
+
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_event = struct.Struct('iIII') # wd, mask, cookie, len
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return _libc
+
+
+def _check(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+class TreeWatcher:
+    """Watches a directory tree and calls callback(path, recursive) for each change.
+    path is relative to the root of the tree, starting with '/'. recursive is True when everything below path may have changed as well.
+    Contents changes are reported when a file written to is closed.
+    Raises OSError if the tree can't be watched whole (e.g. ENOSPC: fs.inotify.max_user_watches exceeded). Directories created later which can't be watched set complete to False, and changes in them go unnoticed.
+    """
+    def __init__(self, root, callback):
+        self.root = root.rstrip('/')
+        self.callback = callback
+        self.libc = _get_libc()
+        self.fd = _check(self.libc.inotify_init1(IN_CLOEXEC))
+        self.wake_r, self.wake_w = os.pipe() # wakes up the reading thread on stop()
+        self.paths = {} # watch descriptor to relative path
+        self.complete = True # all directories are watched
+        self.lock = threading.Lock() # guards paths, complete and running
+        self.running = True
+        try:
+            self.add_tree('/', strict=True)
+        except:
+            for fd in (self.fd, self.wake_r, self.wake_w):
+                os.close(fd)
+            raise
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_tree(self, path, strict=False):
+        """strict: raise errors instead of marking the watcher incomplete"""
+        for directory, dirnames, filenames in os.walk(self.root + path):
+            relpath = directory[len(self.root):] or '/'
+            try:
+                wd = _check(self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK))
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR): # removed meanwhile
+                    continue
+                if strict:
+                    raise
+                logger.error("can't watch {!r}, changes inside will be missed: {}".format(directory, e))
+                with self.lock:
+                    self.complete = False
+                continue
+            with self.lock:
+                self.paths[wd] = relpath
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        try:
+            os.write(self.wake_w, b'\0')
+        except OSError: # reading thread gone already
+            pass
+        os.close(self.wake_w)
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        poller.register(self.wake_r, select.POLLIN)
+        try:
+            while True:
+                ready = [fd for fd, event in poller.poll()]
+                if self.wake_r in ready:
+                    break
+                data = os.read(self.fd, 2 ** 16)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, length = _event.unpack_from(data, offset)
+                    offset += _event.size
+                    name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                    offset += length
+                    try:
+                        self._handle(wd, mask, name)
+                    except Exception:
+                        logger.exception("handling change failed")
+        finally:
+            os.close(self.fd) # drops all watches
+            os.close(self.wake_r)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW: # events were lost
+            self.callback('/', True)
+            return
+        if mask & IN_IGNORED:
+            with self.lock:
+                self.paths.pop(wd, None)
+            return
+        with self.lock:
+            directory = self.paths.get(wd)
+        if directory is None:
+            return
+        if not name: # event on the watched directory itself
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.callback(directory, True)
+            else:
+                self.callback(directory, False)
+            return
+        path = os.path.join(directory, name)
+        is_dir = bool(mask & IN_ISDIR)
+        if is_dir and mask & IN_MOVED_FROM: # watches below keep the old path
+            prefix = path + '/'
+            with self.lock:
+                moved = [moved_wd for moved_wd, moved_path in self.paths.items()
+                         if moved_path == path or moved_path.startswith(prefix)]
+                for moved_wd in moved:
+                    del self.paths[moved_wd]
+            for moved_wd in moved:
+                self.libc.inotify_rm_watch(self.fd, moved_wd)
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_tree(path)
+        self.callback(path, is_dir and bool(mask & (IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE | IN_CREATE)))
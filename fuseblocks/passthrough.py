@@ -1,5 +1,9 @@
 import os.path
+from os.path import stat
 import errno
+import time
+import threading
+from collections import OrderedDict
 from fuse import FuseOSError
 from .base import Block
 
@@ -11,11 +15,13 @@ def pass_to_parent(func_name):
 
 
 class Passthrough(Block):
-    """Passes requests through to parent block."""
+    """Passes requests through to parent block. Stateless, as safe as the parent."""
     REALFS_RESOLVE = True # if parent block is backed by a real filesystem, skip the intermediate calls and use the file directly (TODO: is this correct?)
     def __init__(self, parent):
         Block.__init__(self)
         self.parent = parent
+        self.backend = parent # older name, used by FilterBlock and examples
+        parent.add_listener(self)
         if self.REALFS_RESOLVE and hasattr(parent, '_get_base_path'): # poke a hole through the abstraction to see if file has an underlying FS file
             self._get_base_path = lambda path: self._apply_method('_get_base_path', path)
 
@@ -25,34 +31,182 @@ class Passthrough(Block):
     readlink = pass_to_parent('readlink')
     statvfs = pass_to_parent('statvfs')
     readdir = pass_to_parent('readdir')
+    estimate_size = pass_to_parent('estimate_size')
+
+    def readdir_attrs(self, path):
+        cls = type(self)
+        if cls.readdir is not Passthrough.readdir: # entries may differ from parent's
+            return Block.readdir_attrs(self, path)
+        entries = self._apply_method('readdir_attrs', path)
+        if cls.getattr is not Passthrough.getattr: # parent's stats would bypass getattr
+            return [(name, st_type, None) for name, st_type, st in entries]
+        return entries
 
     def _apply_method(self, func_name, path, *args, **kwargs):
         """Override this to alter behaviour."""
         return getattr(self.parent, func_name)(path, *args, **kwargs)
 
 
+OPERATIONS = ('access', 'getattr', 'open', 'readlink', 'statvfs', 'readdir', 'readdir_attrs', 'estimate_size')
+_DEPENDENCIES = {'readdir_attrs': ('readdir', 'getattr')} # Passthrough.readdir_attrs behaves differently when these are overridden
+
+
+def _passes_through(block, name):
+    """Checks whether calling operation name on block is equivalent to calling it on the parent."""
+    cls = type(block)
+    if cls._apply_method is not Passthrough._apply_method:
+        return False
+    for method in (name,) + _DEPENDENCIES.get(name, ()):
+        if getattr(cls, method) is not getattr(Passthrough, method):
+            return False
+    return True
+
+
+def _children(block):
+    """Blocks referenced by block, including ones in lists and tuples (e.g. conversions)."""
+    for value in vars(block).values():
+        if isinstance(value, Block):
+            yield value
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, Block):
+                    yield item
+                elif isinstance(item, (list, tuple)):
+                    for element in item:
+                        if isinstance(element, Block):
+                            yield element
+
+
+def flatten_stack(block):
+    """Binds operations of pure passthrough hops directly to the block implementing them further down, for the whole stack under block.
+    Blocks overriding an operation or _apply_method are left alone. Parents must not be replaced after flattening.
+    """
+    seen = set()
+    pending = [block]
+    while pending:
+        current = pending.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        pending.extend(_children(current))
+        if not isinstance(current, Passthrough):
+            continue
+        for name in OPERATIONS:
+            if not _passes_through(current, name):
+                continue
+            target = current.parent
+            while isinstance(target, Passthrough) and _passes_through(target, name):
+                target = target.parent
+            setattr(current, name, getattr(target, name))
+
+
 class OverlayBlock(Passthrough):
-    def __init__(self, base, overlay):
+    """Merges directory trees of several blocks. Paths present in more than one layer are taken from the last one: OverlayBlock(base, overlay1, overlay2).
+    Which layer owns each name is indexed per directory when it's listed, or when a path inside is first used. Up to MAX_DIRECTORIES indices are kept for INDEX_TTL seconds (None: until invalidated). Call invalidate() when layers change.
+    Names missing from an index are looked up in the layers directly, so entries created later are found without invalidate(). An index older than MISS_RESCAN seconds (None: never) is rebuilt on a miss instead.
+    The index is guarded by a lock, layers are listed outside of it.
+    """
+    MAX_DIRECTORIES = 1024
+    INDEX_TTL = 10
+    MISS_RESCAN = 1
+    def __init__(self, base, *overlays):
         Passthrough.__init__(self, base)
-        self.overlay = overlay
+        self.overlay = overlays[-1] if overlays else base
+        self.layers = (base,) + overlays # lowest precedence first
+        for overlay in overlays:
+            overlay.add_listener(self)
+        self.presence = OrderedDict() # directory path to (expiry, creation time, {name: (layer, file type, stat)}), least recently used first
+        self.lock = threading.Lock() # guards presence
     
     def readdir(self, path):
-        def get_entries(source, path):
+        return [name for name, st_type, st in self.readdir_attrs(path)]
+
+    def readdir_attrs(self, path):
+        return [(name, st_type, st) for name, (layer, st_type, st) in self._index(path)[2].items()]
+
+    def _index(self, path):
+        """Lists the directory in all layers and remembers owners of entries. Returns the index entry."""
+        owners = {}
+        for layer in self.layers:
             try:
-                return source.readdir(path)
+                entries = layer.readdir_attrs(path)
             except FuseOSError as e:
-                if e.errno != errno.ENOENT:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
                     raise e
-                return []
-        
-        return list(frozenset(get_entries(self.parent, path)) \
-                    .union(get_entries(self.overlay, path)))
+                continue
+            for name, st_type, st in entries:
+                owners[name] = (layer, st_type, st) # later layers take precedence
+        now = time.monotonic()
+        expiry = None if self.INDEX_TTL is None else now + self.INDEX_TTL
+        item = (expiry, now, owners)
+        with self.lock:
+            self.presence[path] = item
+            self.presence.move_to_end(path)
+            while len(self.presence) > self.MAX_DIRECTORIES:
+                self.presence.popitem(last=False)
+        return item
+
+    def _get_index(self, path):
+        with self.lock:
+            item = self.presence.get(path)
+            if item is not None:
+                if item[0] is None or item[0] >= time.monotonic():
+                    self.presence.move_to_end(path)
+                    return item
+                del self.presence[path]
+        return self._index(path)
+
+    def find_layer(self, path):
+        """Returns the layer which owns path. Raises ENOENT."""
+        directory, name = os.path.split(path)
+        if not name: # root exists in all layers
+            return self.layers[-1]
+        expiry, created, owners = self._get_index(directory)
+        owner = owners.get(name)
+        if owner is None: # may have been created since
+            if self.MISS_RESCAN is not None and time.monotonic() - created > self.MISS_RESCAN:
+                owner = self._index(directory)[2].get(name)
+            else:
+                owner = self._probe(directory, name, owners)
+        if owner is None:
+            raise FuseOSError(errno.ENOENT)
+        return owner[0]
+
+    def _probe(self, directory, name, owners):
+        """Looks name up in the layers without listing them, adds it to the index of directory if found."""
+        path = os.path.join(directory, name)
+        for layer in reversed(self.layers):
+            try:
+                st = layer.getattr(path)
+            except FuseOSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise e
+                continue
+            owner = (layer, stat.S_IFMT(st.st_mode), None)
+            with self.lock:
+                item = self.presence.get(directory)
+                if item is not None and item[2] is owners: # indices are replaced, not changed
+                    updated = dict(owners)
+                    updated[name] = owner
+                    self.presence[directory] = (item[0], item[1], updated)
+            return owner
+        return None
+
+    def invalidate(self, path, recursive=False):
+        """Forgets owners in the directory containing path, and in path itself if it's a directory.
+        recursive: also forget all directories below path
+        """
+        with self.lock:
+            self.presence.pop(path, None)
+            self.presence.pop(os.path.dirname(path), None)
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                for indexed in [p for p in self.presence if p.startswith(prefix)]:
+                    del self.presence[indexed]
+
+    def invalidate_all(self):
+        with self.lock:
+            self.presence.clear()
     
     def _apply_method(self, func_name, path, *args, **kwargs):
-        ovf = getattr(self.overlay, func_name)
-        try:
-            return ovf(path, *args, **kwargs)
-        except FuseOSError as e:
-            if e.errno != errno.ENOENT:
-                raise e
-        return Passthrough._apply_method(self, func_name, path, *args, **kwargs)
+        return getattr(self.find_layer(path), func_name)(path, *args, **kwargs)
@@ -1,19 +1,122 @@
 import errno
+import mmap
 import os.path
+from os.path import stat
 from fuse import FuseOSError
-from .base import Block, OpenFile, BlockException
+from .base import Block, OpenFile, BlockException, open_direction, overrides, buffer_pool
+from .inotify import TreeWatcher
 
 
 """File containing filesystem blocks"""
 
 class FSFile(OpenFile):
-    """File object that accesses a file on a host filesystem."""
+    """File object that accesses a file on a host filesystem.
+    USE_MMAP serves read-only files from a memory mapping. Only safe for files which are not truncated while open.
+    SEQUENTIAL advises the kernel to read ahead aggressively.
+    Reads use pread or the mapping, which don't move a shared file position, so they are safe from many threads.
+    """
+    USE_MMAP = False
+    SEQUENTIAL = False
     def __init__(self, path, flags):
         self.fd = os.open(path, flags)
+        self.map = None
+        if self.USE_MMAP and open_direction(flags) == os.O_RDONLY:
+            try:
+                self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError): # empty or not a regular file
+                pass
+        if self.SEQUENTIAL:
+            if self.map is not None:
+                if hasattr(self.map, 'madvise'):
+                    self.map.madvise(mmap.MADV_SEQUENTIAL)
+            elif hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
     
     def read(self, size, offset):
-        os.lseek(self.fd, offset, 0)
-        return os.read(self.fd, size)
+        if self.map is not None:
+            return self.map[offset:offset + size]
+        return os.pread(self.fd, size, offset)
+
+    def readinto(self, buf, offset):
+        if overrides(self, FSFile, 'read'):
+            return OpenFile.readinto(self, buf, offset)
+        if self.map is not None:
+            with memoryview(self.map) as view, view[offset:offset + len(buf)] as part:
+                n = len(part)
+                memoryview(buf)[:n] = part
+            return n
+        return os.preadv(self.fd, [buf], offset)
+
+    def get_copy_fd(self):
+        """Returns fd for copying inside the kernel, unless a subclass changes how data is read."""
+        if overrides(self, FSFile, 'read', 'readinto'):
+            return None
+        return self.fd
+
+    def release(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+
+COPY_CHUNK = 2 ** 30 # bytes per kernel copy call
+
+
+def _copy_file_range(src_fd, dest_fd, offset):
+    return os.copy_file_range(src_fd, dest_fd, COPY_CHUNK, offset, offset)
+
+
+def _sendfile(src_fd, dest_fd, offset):
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    return os.sendfile(dest_fd, src_fd, offset, COPY_CHUNK)
+
+
+def _copy_buffered(src_fd, dest_fd, offset):
+    with buffer_pool.buffer() as buf, memoryview(buf) as view:
+        n = os.preadv(src_fd, [buf], offset)
+        written = 0
+        while written < n:
+            written += os.pwrite(dest_fd, view[written:n], offset + written)
+    return n
+
+
+_copies = [copy for name, copy in (('copy_file_range', _copy_file_range), ('sendfile', _sendfile))
+           if hasattr(os, name)] + [_copy_buffered]
+_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def copy_fd(src_fd, dest_fd):
+    """Copies the whole contents of src_fd to the start of dest_fd, inside the kernel if the filesystems allow. Returns the number of bytes copied.
+    Some filesystems (procfs, some FUSE and network mounts) report nothing to copy for files with data, so a kernel copy finding no data at the start is retried with the next method.
+    """
+    offset = 0
+    for copy in _copies:
+        try:
+            while True:
+                n = copy(src_fd, dest_fd, offset)
+                if n == 0:
+                    if offset == 0 and copy is not _copy_buffered:
+                        break
+                    return offset
+                offset += n
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copy is _copy_buffered:
+                raise
+    return offset
+
+
+def scandir_type(entry):
+    """File type of os.DirEntry, as getattr would report it, without a stat call. None when unknown."""
+    try:
+        if entry.is_symlink(): # getattr follows links
+            return None
+        if entry.is_dir(follow_symlinks=False):
+            return stat.S_IFDIR
+        if entry.is_file(follow_symlinks=False):
+            return stat.S_IFREG
+    except OSError:
+        pass
+    return None
 
 
 def path_translated(method):
@@ -23,14 +126,32 @@ def path_translated(method):
 
 
 class DirectoryBlock(Block):
-    """This block accesses a directory on a host filesystem."""
+    """This block accesses a directory on a host filesystem.
+    With WATCH, changes to the directory are detected using inotify and announced to blocks stacked above (see Block.changed), so they can cache without expiry.
+    Holds no state besides the watcher, all calls go straight to the OS.
+    """
     OpenFile = FSFile
+    SCANDIR_STAT = False # include stat results in readdir_attrs
+    WATCH = False
     
     def __init__(self, base_dir):
         Block.__init__(self)
         if not os.path.isdir(base_dir):
             raise BlockException("Not a directory, can't use for backend: {!r}".format(base_dir))
         self.base_dir = base_dir
+        self.watcher = None
+        if self.WATCH:
+            self.watch()
+
+    def watch(self):
+        """Starts announcing changes in the directory. Raises OSError if it can't be watched whole, see TreeWatcher."""
+        if self.watcher is None:
+            self.watcher = TreeWatcher(self.base_dir, self.changed)
+
+    def unwatch(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
     
     def _get_base_path(self, relpath):
         return self.base_dir + relpath
@@ -56,6 +177,17 @@ class DirectoryBlock(Block):
     @path_translated
     def readdir(self, path):
         return os.listdir(path)
+
+    @path_translated
+    def readdir_attrs(self, path):
+        """File types come from the directory listing. Stats cost a syscall per entry, included only if SCANDIR_STAT is set."""
+        try:
+            with os.scandir(path) as entries:
+                if self.SCANDIR_STAT:
+                    return [(entry.name, scandir_type(entry), entry.stat()) for entry in entries]
+                return [(entry.name, scandir_type(entry), None) for entry in entries]
+        except OSError as e:
+            raise FuseOSError(e.errno) from e
     
     @path_translated
     def readlink(self, path):
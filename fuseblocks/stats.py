@@ -0,0 +1,188 @@
+"""Instrumentation of block stacks, exposed as a file inside the mount."""
+
+import os
+import time
+import json
+import errno
+import weakref
+import itertools
+import threading
+from os.path import stat
+from fuse import FuseOSError
+
+from .base import OpenFile, VirtStat, open_direction
+from .passthrough import Passthrough
+
+
+HISTOGRAM_BUCKETS = 32 # powers of 2 of microseconds
+
+
+class OperationStats:
+    """Counters of a single operation."""
+    __slots__ = ('calls', 'errors', 'bytes', 'total_time', 'histogram')
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_time = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, duration, error, size):
+        self.calls += 1
+        self.errors += error
+        self.bytes += size
+        self.total_time += duration
+        bucket = min(int(duration * 10**6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'total_us': int(self.total_time * 10**6),
+                'latency_us': dict(('<{}'.format(2 ** bucket), count)
+                                   for bucket, count in enumerate(self.histogram)
+                                   if count)}
+
+
+_registry = weakref.WeakSet() # all live StatsBlocks, reported together
+_registry_ids = itertools.count() # numbers default names
+_registry_lock = threading.Lock() # guards both
+
+
+def snapshot():
+    """Returns statistics of all StatsBlocks as a dictionary."""
+    with _registry_lock:
+        blocks = list(_registry)
+    return dict((block.name, block.get_stats()) for block in blocks)
+
+
+class StatsFile(OpenFile):
+    """Wraps an open file to measure reads."""
+    def __init__(self, open_file, block):
+        self.f = open_file
+        self.block = block
+
+    def read(self, size, offset):
+        start = time.perf_counter()
+        try:
+            data = self.f.read(size, offset)
+        except:
+            self.block.record('read', time.perf_counter() - start, True)
+            raise
+        self.block.record('read', time.perf_counter() - start, False, len(data))
+        return data
+
+    def readinto(self, buf, offset):
+        start = time.perf_counter()
+        try:
+            n = self.f.readinto(buf, offset)
+        except:
+            self.block.record('read', time.perf_counter() - start, True)
+            raise
+        self.block.record('read', time.perf_counter() - start, False, n)
+        return n
+
+    def release(self):
+        start = time.perf_counter()
+        try:
+            return self.f.release()
+        finally:
+            self.block.record('release', time.perf_counter() - start, False)
+
+    def __getattr__(self, name): # e.g. get_size
+        return getattr(self.f, name)
+
+
+class ReportFile(OpenFile):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size, offset):
+        return self.data[offset:offset + size]
+
+
+class StatsBlock(Passthrough):
+    """Counts calls, errors, bytes read and latencies of operations passing through.
+    Can be inserted anywhere in the stack. Statistics of all StatsBlocks are served as JSON in the read-only file STATS_PATH by the topmost one.
+    Counters are updated under a lock, measured calls run outside of it.
+    Like process output, the report has size 0 and is built on open; read it through a mount with direct_io.
+    """
+    STATS_PATH = '/.fuseblocks/stats'
+    def __init__(self, parent, name=None):
+        Passthrough.__init__(self, parent)
+        self.stats_dir = os.path.dirname(self.STATS_PATH)
+        self.operations = {} # name to OperationStats
+        self.lock = threading.Lock() # guards operations
+        with _registry_lock:
+            if name is None:
+                name = '{}{}'.format(type(parent).__name__, next(_registry_ids))
+            self.name = name
+            _registry.add(self)
+
+    def record(self, func_name, duration, error, size=0):
+        with self.lock:
+            op_stats = self.operations.get(func_name)
+            if op_stats is None:
+                op_stats = self.operations[func_name] = OperationStats()
+            op_stats.add(duration, error, size)
+
+    def get_stats(self):
+        with self.lock:
+            return dict((name, op_stats.as_dict()) for name, op_stats in self.operations.items())
+
+    def _apply_method(self, func_name, path, *args, **kwargs):
+        if path == self.STATS_PATH or path == self.stats_dir:
+            return self._serve(func_name, path, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            ret = Passthrough._apply_method(self, func_name, path, *args, **kwargs)
+        except:
+            self.record(func_name, time.perf_counter() - start, True)
+            raise
+        self.record(func_name, time.perf_counter() - start, False)
+        if func_name == 'open':
+            ret = StatsFile(ret, self)
+        elif func_name in ('readdir', 'readdir_attrs') and path == os.path.dirname(self.stats_dir):
+            ret = self._add_stats_dir(func_name, ret)
+        return ret
+
+    def _add_stats_dir(self, func_name, entries):
+        name = os.path.basename(self.stats_dir)
+        entries = list(entries)
+        if func_name == 'readdir':
+            if name not in entries:
+                entries.append(name)
+        elif name not in (entry[0] for entry in entries):
+            entries.append((name, stat.S_IFDIR, None))
+        return entries
+
+    def _serve(self, func_name, path, *args, **kwargs):
+        is_dir = path == self.stats_dir
+        if func_name == 'getattr':
+            now = time.time()
+            if is_dir:
+                return VirtStat(st_mode=stat.S_IFDIR | 0o555, st_nlink=2,
+                                st_atime=now, st_mtime=now, st_ctime=now)
+            return VirtStat(st_mode=stat.S_IFREG | 0o444, st_nlink=1,
+                            st_atime=now, st_mtime=now, st_ctime=now)
+        if func_name == 'access':
+            mode = args[0]
+            if mode & os.W_OK or (mode & os.X_OK and not is_dir):
+                raise FuseOSError(errno.EACCES)
+            return 0
+        if is_dir and func_name == 'readdir':
+            return [os.path.basename(self.STATS_PATH)]
+        if is_dir and func_name == 'readdir_attrs':
+            return [(os.path.basename(self.STATS_PATH), stat.S_IFREG, None)]
+        if not is_dir and func_name == 'open':
+            if open_direction(args[0]) != os.O_RDONLY:
+                raise FuseOSError(errno.EACCES)
+            return ReportFile(json.dumps(snapshot(), indent=1, sort_keys=True).encode('utf-8'))
+        if func_name == 'estimate_size':
+            return None
+        if func_name == 'statvfs':
+            return Passthrough._apply_method(self, func_name, '/')
+        if func_name == 'readlink':
+            raise FuseOSError(errno.EINVAL)
+        raise FuseOSError(errno.EISDIR if is_dir else errno.ENOTDIR)
@@ -1,24 +1,116 @@
 import os
 import sys
 import subprocess
+import time
+import heapq
+import itertools
+import tempfile
+import threading
+import contextlib
 import errno
+import dbm
+from collections import OrderedDict
 from abc import ABCMeta, abstractmethod
 from fuse import FuseOSError
-from .base import Block, OpenFile, VirtStat, open_direction
+from .base import Block, OpenFile, VirtStat, PathLocks, buffer_pool, overrides, open_direction, stat_fingerprint, SIZE_EXACT_ALWAYS, SIZE_EXACT_ON_OPEN
 from .realfs import DirectoryBlock, path_translated
 from .passthrough import Passthrough
 from .cache import DataCacheBlock
 
 
+INTERACTIVE = 0
+BACKGROUND = 1
+_priority = threading.local()
+
+
+def current_priority():
+    return getattr(_priority, 'value', INTERACTIVE)
+
+
+@contextlib.contextmanager
+def background_priority():
+    """Processes started by the current thread inside this context wait behind interactive ones."""
+    previous = current_priority()
+    _priority.value = BACKGROUND
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+class ProcessLimiter:
+    """Limits the number of processes running at the same time.
+    Waiting requests are admitted in order of priority, then arrival.
+    limit: maximum number of processes, None for unlimited
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.running = 0
+        self.waiting = [] # heap of (priority, sequence number, event)
+        self.sequence = itertools.count()
+        self.admitted = 0
+        self.total_wait = 0.0 # seconds
+        self.max_wait = 0.0
+        self.lock = threading.Lock() # guards all of the above
+
+    def acquire(self, priority=INTERACTIVE):
+        start = time.monotonic()
+        with self.lock:
+            if not self.waiting and (self.limit is None or self.running < self.limit):
+                self.running += 1
+                self.admitted += 1
+                return
+            event = threading.Event()
+            heapq.heappush(self.waiting, (priority, next(self.sequence), event))
+        event.wait() # the slot is handed over by release()
+        waited = time.monotonic() - start
+        with self.lock:
+            self.admitted += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def release(self):
+        with self.lock:
+            if self.waiting and (self.limit is None or self.running <= self.limit):
+                priority, seq, event = heapq.heappop(self.waiting)
+                event.set()
+            else:
+                self.running -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'running': self.running,
+                    'queued': len(self.waiting),
+                    'admitted': self.admitted,
+                    'mean_wait': self.total_wait / self.admitted if self.admitted else 0.0,
+                    'max_wait': self.max_wait}
+
+
+global_limiter = ProcessLimiter() # shared by all process blocks; set limit to restrict
+
+
 class ProcessFSFile(OpenFile):
-    """This file type allows passing a real file through a process and exposing the contents."""
+    """This file type allows passing a real file through a process and exposing the contents.
+    Without spooling, reads must be sequential. With spool enabled, output is kept (in memory up to spool_memory bytes, then in a temporary file), which allows reading at any offset, and so caching by the kernel.
+    Reads are serialized by a lock, since they consume a single pipe.
+    """
     parent_stderr = True    # print child process stderr output to the FUSE process stderr (usually console)
     exit_timeout = 60   # timeout after which close() call will return after an unsuccessful killing
+    spool = False
+    spool_memory = 2 ** 24
+    limiters = () # ProcessLimiter slots held by this file, released once output ends or the process exits, at latest on release()
     def __init__(self, path, flags):
         if flags & os.O_APPEND:
             raise FuseOSError(errno.EACCES)
+        self.released = False
+        self.limiters_lock = threading.Lock() # guards limiters
         self.set_properties(path, flags)
         self.process = self.start_process(path, flags)
+        self.spool_file = None
+        self.lock = threading.Lock() # guards read_offset, spool_file position and the pipe
+        if self.spool and self.readable:
+            self.spool_file = tempfile.SpooledTemporaryFile(max_size=self.spool_memory)
+            self.eof = False
     
     def set_properties(self, path, flags):
         direction = open_direction(flags)
@@ -41,22 +133,74 @@ class ProcessFSFile(OpenFile):
     def read(self, size, offset):
         if not self.readable:
             raise FuseOSError(errno.EACCES)
-        if self.read_offset != offset:
-            raise FuseOSError(errno.EIO)
+        if self.spool_file is not None:
+            return self.read_spooled(size, offset)
+        with self.lock:
+            if self.read_offset != offset:
+                raise FuseOSError(errno.EIO)
+            ret = self.read_process(size)
+            self.read_offset += len(ret)
+        return ret
+
+    def readinto(self, buf, offset):
+        if (not self.readable or self.spool_file is not None
+                or overrides(self, ProcessFSFile, 'read', 'read_process')):
+            return OpenFile.readinto(self, buf, offset)
+        with self.lock:
+            if self.read_offset != offset:
+                raise FuseOSError(errno.EIO)
+            n = self.process.stdout.readinto(buf)
+            self.check_read(n, len(buf))
+            self.read_offset += n
+        return n
+
+    def read_process(self, size):
         ret = self.process.stdout.read(size)
-        
+        self.check_read(len(ret), size)
+        return ret
+
+    def check_read(self, length, size):
+        """Called after reading length bytes of output when size were requested."""
+        if length < size or self.process.poll() is not None: # the process is done, its slot can be used by others
+            self.release_limiters()
         if self.check_failed(): # check if process returned with an acceptable error code
             raise FuseOSError(errno.EIO)
-        
-        self.read_offset += len(ret)
-        return ret
+
+    def release_limiters(self):
+        with self.limiters_lock:
+            limiters, self.limiters = self.limiters, ()
+        for limiter in limiters:
+            limiter.release()
+
+    def read_spooled(self, size, offset):
+        end = offset + size
+        with self.lock:
+            if self.read_offset < end and not self.eof:
+                self.spool_file.seek(self.read_offset)
+                while self.read_offset < end:
+                    chunk = self.read_process(2 ** 16) # bounded, whatever the distance
+                    if len(chunk) == 0:
+                        self.eof = True
+                        break
+                    self.spool_file.write(chunk)
+                    self.read_offset += len(chunk)
+            if offset >= self.read_offset:
+                return b''
+            self.spool_file.seek(offset)
+            return self.spool_file.read(min(end, self.read_offset) - offset)
     
     def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.spool_file is not None:
+            self.spool_file.close()
         try:
             self.process.kill()
             self.process.wait(self.exit_timeout)
         except ProcessLookupError: # process doesn't exist already
             pass
+        self.release_limiters()
 
     def check_failed(self):
         """Method checking whether the process exited with an error, producing invalid output. Override to customize acceptable error codes."""
@@ -86,53 +230,159 @@ class RawProcessBlockFS(Passthrough):
     """
     Block mixin that passes files on the filesystem through a process.
     It requires a real file, so it will only work with unbroken chains to DirectoryBlock.
+    At most MAX_PROCESSES processes per block run at once (None for no limit), in addition to the limit of global_limiter.
+    Output size is estimated as SIZE_RATIO times the source size, override estimate_size for better guesses (e.g. from headers).
+    Every open starts its own process; limiters are the only shared state.
     """
     OpenFile = ProcessFSFile
+    MAX_PROCESSES = None
+    SIZE_RATIO = None
+    def __init__(self, parent):
+        Passthrough.__init__(self, parent)
+        self.limiter = ProcessLimiter(self.MAX_PROCESSES)
+
     def getattr(self, path):
         ret = VirtStat.from_stat(os.stat(self._get_base_path(path)))
         ret.st_size = 0
         return ret
 
+    def estimate_size(self, path):
+        if self.SIZE_RATIO is None:
+            return None
+        return int(os.stat(self._get_base_path(path)).st_size * self.SIZE_RATIO) + 1
+
     def open(self, path, flags):
-        return self.OpenFile(self._get_base_path(path), flags)
+        priority = current_priority()
+        acquired = []
+        try:
+            for limiter in (self.limiter, global_limiter):
+                limiter.acquire(priority)
+                acquired.append(limiter)
+            f = self.OpenFile(self._get_base_path(path), flags)
+        except:
+            for limiter in acquired:
+                limiter.release()
+            raise
+        f.limiters = acquired
+        return f
 
 
 class ProcessBlockFS(Passthrough):
     """Block that passes all files backed by the filesystem through a processing block, and caches them.
     Wraps RawProcessBlockFS.
+    SIZE_POLICY selects when sizes are exact, see base.SIZE_*.
     """
+    SIZE_POLICY = SIZE_EXACT_ALWAYS
     def __init__(self, process_backend):
         Passthrough.__init__(self, VerifySizeBlock(
                                    DataCacheBlock(
-                                   process_backend)))
+                                   process_backend),
+                                   self.SIZE_POLICY))
 
 
 def read_file_size(open_file):
+    """Returns size of the file, reading it whole if it can't tell its size without that."""
+    if hasattr(open_file, 'get_size'):
+        return open_file.get_size()
     offset = 0
-    readsize = 2 ** 16
-    while True:
-        new_data = open_file.read(readsize, offset)
-        offset += len(new_data)
-        if len(new_data) < readsize:
-            break
+    with buffer_pool.buffer() as buf:
+        while True:
+            n = open_file.readinto(buf, offset)
+            offset += n
+            if n < len(buf):
+                break
     return offset
     
 
 class VerifySizeBlock(Passthrough):
     """On first request for the file size (getattr, directory listing), reads the whole file and displays its size.
     Useful only for read-only files.
+    When the backend caches data (DataCacheBlock), the read fills the cache, and sizes of files already cached are taken from there.
+    Up to MAX_SIZES sizes are remembered, and also persisted in SIZES_PATH if set. Entries are invalidated when source metadata changes.
+    Unless size_policy is SIZE_EXACT_ALWAYS, backend's estimate_size is reported until the real size is known. Estimates should be upper bounds, reads past the real end of file return less data.
+    Concurrent requests for the size of the same file wait for a single read.
     """
-    def __init__(self, backend):
+    MAX_SIZES = 2 ** 16
+    SIZES_PATH = None
+    SIZE_POLICY = SIZE_EXACT_ALWAYS
+    def __init__(self, backend, size_policy=None):
         Passthrough.__init__(self, backend)
-        self.sizes = {}
+        self.size_policy = self.SIZE_POLICY if size_policy is None else size_policy
+        self.sizes = OrderedDict() # path to (fingerprint, size), least recently used first
+        self.persisted = None if self.SIZES_PATH is None else dbm.open(self.SIZES_PATH, 'c')
+        self.lock = threading.Lock() # guards sizes and persisted
+        self.path_locks = PathLocks() # serializes measuring
     
     def getattr(self, path):
         ret = VirtStat.from_stat(Passthrough.getattr(self, path))
         if os.path.stat.S_ISDIR(ret.st_mode):
             return ret
-        if path not in self.sizes:
-            open_file = self.open(path, os.O_RDONLY)
-            self.sizes[path] = read_file_size(open_file)
-            open_file.release()
-        ret.st_size = self.sizes[path]
+        fingerprint = stat_fingerprint(ret)
+        size = self.get_known_size(path, fingerprint)
+        if size is None:
+            size = self.parent.cached_size(path) if hasattr(self.parent, 'cached_size') else None
+            if size is None and self.size_policy != SIZE_EXACT_ALWAYS:
+                estimate = self.parent.estimate_size(path)
+                if estimate is not None:
+                    ret.st_size = estimate
+                    return ret
+            if size is None:
+                size = self.measure_size(path, fingerprint)
+            else:
+                self.set_known_size(path, fingerprint, size)
+        ret.st_size = size
         return ret
+
+    def measure_size(self, path, fingerprint):
+        """Reads the whole file to find its size, unless another thread did it meanwhile."""
+        with self.path_locks.locked(path):
+            size = self.get_known_size(path, fingerprint)
+            if size is None:
+                open_file = Passthrough.open(self, path, os.O_RDONLY)
+                try:
+                    size = read_file_size(open_file)
+                finally:
+                    open_file.release()
+                self.set_known_size(path, fingerprint, size)
+        return size
+
+    def open(self, path, flags):
+        if self.size_policy == SIZE_EXACT_ON_OPEN:
+            # measured through its own handle, the returned one may only be readable sequentially
+            fingerprint = stat_fingerprint(Passthrough.getattr(self, path))
+            if self.get_known_size(path, fingerprint) is None:
+                self.measure_size(path, fingerprint)
+        return Passthrough.open(self, path, flags)
+
+    def get_known_size(self, path, fingerprint):
+        with self.lock:
+            item = self.sizes.get(path)
+            if item is None and self.persisted is not None:
+                value = self.persisted.get(path)
+                if value is not None:
+                    known_fingerprint, size = value.decode('ascii').rsplit(' ', 1)
+                    item = known_fingerprint, int(size)
+            if item is None or item[0] != fingerprint:
+                return None
+            self._remember(path, item)
+            return item[1]
+
+    def set_known_size(self, path, fingerprint, size):
+        with self.lock:
+            self._remember(path, (fingerprint, size))
+            if self.persisted is not None:
+                self.persisted[path] = '{} {}'.format(fingerprint, size)
+
+    def invalidate(self, path, recursive=False):
+        with self.lock:
+            self.sizes.pop(path, None)
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                for known in [p for p in self.sizes if p.startswith(prefix)]:
+                    del self.sizes[known]
+
+    def _remember(self, path, item):
+        self.sizes[path] = item
+        self.sizes.move_to_end(path)
+        while len(self.sizes) > self.MAX_SIZES:
+            self.sizes.popitem(last=False)
@@ -1,5 +1,9 @@
 import os.path
 import errno
+import time
+import threading
+from os.path import stat
+from collections import OrderedDict
 from abc import ABCMeta, abstractmethod
 from fuse import FuseOSError
 from . import util
@@ -12,11 +16,35 @@ def pass_back_dec(func_name):
         return self.pass_to_backend(func_name, *args, **kwargs)
     return method
 
+class NameIndex:
+    """Mapping between encoded and decoded entry names of a single directory."""
+    __slots__ = ('dec_path', 'encoded', 'decoded', 'created')
+    def __init__(self, dec_path):
+        self.dec_path = dec_path
+        self.created = time.monotonic()
+        self.encoded = {} # encoded name to decoded name
+        self.decoded = {} # decoded name to encoded name
+
+    def add(self, enc_name, dec_name):
+        self.encoded[enc_name] = dec_name
+        self.decoded[dec_name] = enc_name
+
+
 class TransformNameBlock(Block, metaclass=ABCMeta):
+    """Exposes entries of the backend under different names.
+    Names are indexed per directory when it's listed or when a path inside it is first looked up. Up to MAX_DIRECTORIES indices are kept, least recently used are dropped.
+    Names missing from an index are looked up again by rescanning the directory, at most once per MISS_RESCAN seconds (None: never), so entries created later are found without invalidate().
+    Indices are guarded by a lock. Directories are listed outside of it, so encode_name and encode_entry may run in several threads at once.
+    """
+    MAX_DIRECTORIES = 1024
+    MISS_RESCAN = 1
     def __init__(self, parent_block):
         Block.__init__(self)
         self.backend = parent_block
-        self.path_decodes = {}
+        parent_block.add_listener(self)
+        self.indices = OrderedDict() # encoded directory path to NameIndex, least recently used first
+        self.dec_dirs = {} # decoded directory path to encoded, for indexed directories
+        self.lock = threading.Lock() # guards indices and dec_dirs
     
     access = pass_back_dec('access')
     getattr = pass_back_dec('getattr')
@@ -24,50 +52,171 @@ class TransformNameBlock(Block, metaclass=ABCMeta):
     readlink = pass_back_dec('readlink')
     statvfs = pass_back_dec('statvfs')
 
+    KEEPS_ATTRS = True # whether renamed entries have the same attributes as the original
     def readdir(self, enc_path):
-        dec_path = self.decode_path(enc_path)
-        for dec_entry in self.backend.readdir(dec_path):
-            enc_entry = self._encode_name_save(enc_path, dec_path, dec_entry)
-            if enc_entry is not None:
-                yield enc_entry
+        return list(self._scan(enc_path).encoded)
+
+    def readdir_attrs(self, enc_path):
+        entries = []
+        self._scan(enc_path, entries)
+        return entries
 
     def pass_to_backend(self, method_name, enc_path, *args, **kwargs):
         method = getattr(self.backend, method_name)
         return method(self.decode_path(enc_path), *args, **kwargs)
 
-    def _encode_name_save(self, enc_path, dec_path, dec_entry):
-        enc_name = self.encode_name(dec_path, dec_entry)
-        if enc_name is None:
-            return None
-        
-        self.path_decodes[os.path.join(enc_path, enc_name)] = os.path.join(dec_path, dec_entry)
-        return enc_name
+    def _scan(self, enc_path, attrs=None):
+        """Rebuilds the index of a directory.
+        attrs: list to fill with readdir_attrs entries
+        """
+        dec_path = self.decode_path(enc_path)
+        index = NameIndex(dec_path)
+        for dec_entry, st_type, st in self.backend.readdir_attrs(dec_path):
+            is_dir = None if st_type is None else stat.S_ISDIR(st_type)
+            enc_entry = self.encode_entry(dec_path, dec_entry, is_dir)
+            if enc_entry is not None:
+                index.add(enc_entry, dec_entry)
+                if attrs is not None:
+                    if enc_entry != dec_entry and not self.KEEPS_ATTRS:
+                        st = None
+                    attrs.append((enc_entry, st_type, st))
+        with self.lock:
+            self._drop(enc_path)
+            self.indices[enc_path] = index
+            self.dec_dirs[dec_path] = enc_path
+            while len(self.indices) > self.MAX_DIRECTORIES:
+                self._drop(next(iter(self.indices)))
+        return index
+
+    def _get_index(self, enc_path):
+        with self.lock:
+            index = self.indices.get(enc_path)
+            if index is not None:
+                self.indices.move_to_end(enc_path)
+                return index
+        return self._scan(enc_path)
+
+    def _drop(self, enc_path):
+        """Must be called with lock held."""
+        index = self.indices.pop(enc_path, None)
+        if index is not None and self.dec_dirs.get(index.dec_path) == enc_path:
+            del self.dec_dirs[index.dec_path]
 
     @abstractmethod
     def encode_name(self, dec_path, dec_name):
-        """May not raise errors, return None if has no mapping.
-        """
+        """May not raise errors, return None if has no mapping."""
         pass
+
+    def encode_entry(self, dec_path, dec_name, is_dir):
+        """Encodes a listed entry. is_dir: whether it's a directory, None if not known from the listing.
+        Calls encode_name, override to make use of is_dir.
+        """
+        return self.encode_name(dec_path, dec_name)
         
     def decode_path(self, path):
-        if path not in self.path_decodes:
-            base, entry = os.path.split(path)
-            if base == path: # root
-                self._encode_name_save(base, base, '')
-            else:
-                self.readdir(base) # populate entries
-        try:
-            return self.path_decodes[path]
-        except KeyError:
+        base, entry = os.path.split(path)
+        if not entry: # root
+            return path
+        index = self._get_index(base)
+        dec_entry = index.encoded.get(entry)
+        if (dec_entry is None and self.MISS_RESCAN is not None
+                and time.monotonic() - index.created > self.MISS_RESCAN): # may have been created since
+            index = self._scan(base)
+            dec_entry = index.encoded.get(entry)
+        if dec_entry is None:
             raise FuseOSError(errno.ENOENT)
+        return os.path.join(index.dec_path, dec_entry)
+
+    def encode_path(self, dec_path):
+        """Returns the encoded path of a backend path if its directory is indexed, otherwise None."""
+        dec_base, dec_entry = os.path.split(dec_path)
+        if not dec_entry: # root
+            return dec_path
+        with self.lock:
+            enc_base = self.dec_dirs.get(dec_base)
+            if enc_base is None:
+                return None
+            enc_entry = self.indices[enc_base].decoded.get(dec_entry)
+        if enc_entry is None:
+            return None
+        return os.path.join(enc_base, enc_entry)
+
+    def parent_changed(self, parent, dec_path, recursive):
+        enc_path = self.encode_path(dec_path)
+        if enc_path is None: # name unknown, possibly new: everything below the closest known directory may be affected
+            recursive = True
+            while enc_path is None:
+                dec_path = os.path.dirname(dec_path)
+                enc_path = self.encode_path(dec_path)
+        self.changed(enc_path, recursive)
+
+    def invalidate(self, enc_path, recursive=False):
+        """Forgets names in the directory containing enc_path, and in enc_path itself if it's a directory.
+        recursive: also forget all directories below enc_path
+        """
+        with self.lock:
+            self._drop(enc_path)
+            self._drop(os.path.dirname(enc_path))
+            if recursive:
+                prefix = enc_path.rstrip('/') + '/'
+                for indexed in [p for p in self.indices if p.startswith(prefix)]:
+                    self._drop(indexed)
+
+    def invalidate_all(self):
+        with self.lock:
+            self.indices.clear()
+            self.dec_dirs.clear()
+
+
+class EndingMatcher:
+    """Finds the first conversion in a list whose ending matches a file name.
+    Conversions are tuples starting with (from_ending, to_ending, case_sensitive). Endings are compiled into one table per ending length, so matching costs a dictionary lookup per distinct length.
+    """
+    def __init__(self, conversions):
+        self.conversions = conversions
+        by_length = {} # length to {ending: index of first conversion}
+        for index, conversion in enumerate(conversions):
+            from_ending, to_ending, case_sensitive = conversion[:3]
+            if case_sensitive:
+                from_ending = from_ending.lower()
+            by_length.setdefault(len(from_ending), {}).setdefault(from_ending, index)
+        self.tables = sorted(by_length.items())
+
+    def find(self, name):
+        """Returns the matching conversion or None."""
+        name_low = name.lower()
+        best = None
+        for length, endings in self.tables:
+            if length > len(name_low):
+                break
+            index = endings.get(name_low[len(name_low) - length:])
+            if index is not None and (best is None or index < best):
+                best = index
+        return None if best is None else self.conversions[best]
+
+    def convert(self, name):
+        """Returns name with ending replaced, or None if no conversion matches."""
+        conversion = self.find(name)
+        if conversion is None:
+            return None
+        from_ending, to_ending = conversion[:2]
+        return name[:len(name) - len(from_ending)] + to_ending
 
 
 class FileNameChangeBlock(TransformNameBlock, metaclass=ABCMeta):
     """Changes file names."""
     def encode_name(self, dec_path, dec_name):
-        if util.isdir(self.backend, os.path.join(dec_path, dec_name)): # ignore directories
+        return self.encode_entry(dec_path, dec_name, None)
+
+    def encode_entry(self, dec_path, dec_name, is_dir):
+        enc_name = self.encode_file_name(dec_name)
+        if enc_name == dec_name:
+            return enc_name
+        if is_dir is None:
+            is_dir = util.isdir(self.backend, os.path.join(dec_path, dec_name))
+        if is_dir: # ignore directories
             return dec_name
-        return self.encode_file_name(dec_name)
+        return enc_name
     
     @abstractmethod
     def encode_file_name(self, dec_name): pass
@@ -83,14 +232,15 @@ class FileEndingChangeBlock(FileNameChangeBlock):
                           ("jpg", "png", True)] # this will not work for files ending with "_Africa.jpg" which were matched earlier.
     """
     ending_conversions = []
+    def __init__(self, parent_block):
+        FileNameChangeBlock.__init__(self, parent_block)
+        self.matcher = EndingMatcher(self.ending_conversions)
+
     def encode_file_name(self, dec_name):
-        dec_name_low = dec_name.lower()
-        for from_ending, to_ending, case_sensitive in self.ending_conversions:
-            if case_sensitive:
-                from_ending = from_ending.lower()
-            if dec_name_low.endswith(from_ending):
-                return dec_name[:-len(from_ending)] + to_ending
-        return dec_name # file not in ending list
+        enc_name = self.matcher.convert(dec_name)
+        if enc_name is None:
+            return dec_name # file not in ending list
+        return enc_name
 
 
 def pass_back_dec(func_name):
@@ -102,6 +252,7 @@ def pass_back_dec(func_name):
 
 class ProcessFileByEndingBlock(TransformNameBlock):
     """Pipes files through a backend while at the same time changing its ending."""
+    KEEPS_ATTRS = False
     def __init__(self, parent_block, conversions):
         """Parent block is the backing block for all transformations. It is used for all directory handling and for handling files without any conversion.
         All other file handling goes through block specified in conversion. These blocks must accept the same file names as parent_block.
@@ -110,22 +261,21 @@ class ProcessFileByEndingBlock(TransformNameBlock):
         FileNameChangeBlock.__init__(self, parent_block)
         self.parent_block = parent_block
         self.ending_conversions = conversions
+        self.matcher = EndingMatcher(conversions)
         
     def find_conversion(self, dec_name):
-        dec_name_low = dec_name.lower()
-        for conversion in self.ending_conversions:
-            from_ending, to_ending, case_sensitive, backend = conversion
-            if case_sensitive:
-                from_ending = from_ending.lower()
-            if dec_name_low.endswith(from_ending):
-                return conversion
-        return None # file not in ending list
+        return self.matcher.find(dec_name)
 
-    def get_path_conversion(self, path):
-        if util.isdir(self.backend, path):
+    def get_path_conversion(self, path, is_dir=None):
+        """is_dir: hint, checked with the backend if None"""
+        conversion = self.find_conversion(os.path.basename(path))
+        if conversion is None:
+            return None
+        if is_dir is None:
+            is_dir = util.isdir(self.backend, path)
+        if is_dir:
             return None
-        else:
-            return self.find_conversion(os.path.basename(path))
+        return conversion
 
     def get_backend(self, path):
         conv = self.get_path_conversion(path)
@@ -140,8 +290,11 @@ class ProcessFileByEndingBlock(TransformNameBlock):
         return method(dec_path, *args, **kwargs)
     
     def encode_name(self, dec_path, dec_name):
-        conversion = self.get_path_conversion(os.path.join(dec_path, dec_name))
+        return self.encode_entry(dec_path, dec_name, None)
+
+    def encode_entry(self, dec_path, dec_name, is_dir):
+        conversion = self.get_path_conversion(os.path.join(dec_path, dec_name), is_dir)
         if conversion is None:
             return dec_name
         from_ending, to_ending, case_sensitive, backend = conversion
-        return dec_name[:-len(from_ending)] + to_ending
+        return dec_name[:len(dec_name) - len(from_ending)] + to_ending
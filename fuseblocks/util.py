@@ -5,6 +5,10 @@ def isdir(block, path):
 
 from fuse import FUSE
 from .base import ObjectMapper
+from .passthrough import flatten_stack
 
-def start_fuse(block, mount_directory, *args, mapper_class=ObjectMapper, **kwargs):
+def start_fuse(block, mount_directory, *args, mapper_class=ObjectMapper, flatten=True, **kwargs):
+    """flatten: skip pure passthrough layers, see passthrough.flatten_stack"""
+    if flatten:
+        flatten_stack(block)
     return FUSE(mapper_class(mount_directory, block), mount_directory, **kwargs)